@@ -0,0 +1,29 @@
+from array import array
+from bisect import bisect_left
+
+# -----------------------------------------------------------------------------
+# Compact set of EUIs (8 bytes each) as a sorted array of 64 bit integers
+# -----------------------------------------------------------------------------
+
+class EuiSet():
+
+    def __init__(self, euis=()):
+        values = array('Q', ( int(eui, 16) for eui in euis ))
+        self._values = array('Q')
+        for value in sorted(values):
+            if not self._values or self._values[-1] != value:
+                self._values.append(value)
+
+    def __contains__(self, eui):
+        try:
+            value = int(eui, 16)
+        except (TypeError, ValueError):
+            return False
+        index = bisect_left(self._values, value)
+        return index < len(self._values) and self._values[index] == value
+
+    def __len__(self):
+        return len(self._values)
+
+    def __iter__(self):
+        return ( "%016x" % value for value in self._values )
@@ -0,0 +1,63 @@
+import os
+import hashlib
+
+# -----------------------------------------------------------------------------
+# Append-only checkpoint journal, one line per finished item with its key and
+# optional tab separated fields (the last line for a key wins)
+# -----------------------------------------------------------------------------
+
+class Journal():
+
+    def __init__(self, filename, batch=1, data=None):
+
+        # Items already in the journal (a partial last line is ignored)
+        self.filename = filename
+        self.done = set()
+        self.entries = {}
+        if os.path.exists(filename):
+            with open(filename) as f:
+                for line in f:
+                    if line.endswith("\n") and line.strip():
+                        fields = line.rstrip("\n").split("\t")
+                        self.done.add(fields[0])
+                        self.entries[fields[0]] = fields[1:]
+        self._file = open(filename, "a")
+        # File the items are written to, if any, synced before the journal
+        # so the journal never lists items that did not reach the disk
+        self._data = data
+        self._batch = max(1, int(batch))
+        self._pending = 0
+
+    def __contains__(self, key):
+        return key in self.done
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def add(self, key, *fields):
+
+        # Lines reach the OS right away, fsync only every `batch` lines
+        self._file.write("\t".join([ str(key) ] + [ str(field) for field in fields ]) + "\n")
+        self._file.flush()
+        self.done.add(key)
+        self.entries[key] = [ str(field) for field in fields ]
+        self._pending += 1
+        if self._pending >= self._batch:
+            self.sync()
+
+    def sync(self):
+        if self._pending:
+            if self._data:
+                self._data.flush()
+                os.fsync(self._data.fileno())
+            os.fsync(self._file.fileno())
+            self._pending = 0
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+def row_hash(values):
+
+    # Short hash of the content of a row, to tell if it changed since it was journaled
+    return hashlib.sha1("\x1f".join([ str(value) for value in values ]).encode('utf-8')).hexdigest()[:16]
@@ -0,0 +1,33 @@
+from concurrent.futures import ThreadPoolExecutor
+
+def paginate(method, req, metadata=None, page_size=1000, prefetch=False):
+
+    # Walk a ChirpStack List* RPC page by page and yield the items one by one.
+    # `req` is the request with the filters already set, `limit` and `offset`
+    # are handled here. When `prefetch` is set the next page is requested
+    # while the current one is being consumed.
+    page_size = max(1, int(page_size))
+
+    def fetch(offset):
+        page = type(req)()
+        page.CopyFrom(req)
+        page.limit = page_size
+        page.offset = offset
+        return method(page, metadata=metadata)
+
+    offset = 0
+    resp = fetch(offset)
+    executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+    try:
+        while True:
+            offset += page_size
+            more = len(resp.result) == page_size and offset < resp.total_count
+            future = executor.submit(fetch, offset) if (more and executor) else None
+            for item in resp.result:
+                yield item
+            if not more:
+                break
+            resp = future.result() if future else fetch(offset)
+    finally:
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
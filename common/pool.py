@@ -0,0 +1,28 @@
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+def ordered_map(func, items, workers=8, window=None):
+
+    # Run `func` over `items` using a pool of threads and yield the results
+    # in the same order as the input. At most `window` calls are in flight
+    # at any time so the input can be a (long) generator.
+    workers = max(1, int(workers))
+    window = max(workers, int(window or workers * 4))
+
+    if 1 == workers:
+        for item in items:
+            yield func(item)
+        return
+
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for item in items:
+                pending.append(executor.submit(func, item))
+                if len(pending) >= window:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
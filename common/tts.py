@@ -0,0 +1,151 @@
+import json
+import threading
+import http.client
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+# -----------------------------------------------------------------------------
+# Minimal client for The Things Stack v3 HTTP API
+# -----------------------------------------------------------------------------
+
+# Fields read from each server component for the export
+JS_FIELDS = [ "root_keys.app_key.key" ]
+NS_FIELDS = [ "session.dev_addr", "session.keys.f_nwk_s_int_key.key", "session.keys.s_nwk_s_int_key.key", "session.keys.nwk_s_enc_key.key", "session.last_f_cnt_up", "session.last_n_f_cnt_down" ]
+AS_FIELDS = [ "session.keys.app_s_key.key", "session.last_a_f_cnt_down" ]
+
+class TTSError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(f"HTTP {status}: {message}")
+        self.status = status
+
+def merge(target, source):
+
+    # Deep merge of the JSON objects returned by the different components
+    for (key, value) in source.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge(target[key], value)
+        else:
+            target[key] = value
+    return target
+
+class Client():
+
+    def __init__(self, url, apikey, timeout=10, workers=8):
+
+        # url like https://eu1.cloud.thethings.network (or http://localhost:8885 for testing)
+        url = url if "://" in url else f"https://{url}"
+        parsed = urllib.parse.urlsplit(url)
+        self._secure = "https" == parsed.scheme
+        self._host = parsed.netloc
+        self._prefix = parsed.path.rstrip('/')
+        self._headers = {
+            "Authorization": f"Bearer {apikey}",
+            "Accept": "application/json",
+            "Connection": "keep-alive",
+        }
+        self._timeout = timeout
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, int(workers)) * 3)
+
+    def _connection(self):
+
+        # One keep-alive connection per thread, http.client is not thread safe
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            if self._secure:
+                connection = http.client.HTTPSConnection(self._host, timeout=self._timeout)
+            else:
+                connection = http.client.HTTPConnection(self._host, timeout=self._timeout)
+            self._local.connection = connection
+        return connection
+
+    def request(self, method, path, params=None):
+
+        url = self._prefix + path
+        if params:
+            url += "?" + urllib.parse.urlencode(params)
+
+        # Retry once on a fresh connection if the server closed the idle one
+        for attempt in range(2):
+            connection = self._connection()
+            try:
+                connection.request(method, url, headers=self._headers)
+                response = connection.getresponse()
+                body = response.read()
+                break
+            except (http.client.HTTPException, ConnectionError) as err:
+                connection.close()
+                self._local.connection = None
+                if attempt > 0:
+                    raise
+        if response.status >= 400:
+            try:
+                message = json.loads(body).get("message", "")
+            except Exception:
+                message = body[:200].decode('utf-8', 'replace')
+            raise TTSError(response.status, message)
+        return (json.loads(body) if body else {}, response.headers)
+
+    def paginate(self, path, key, fields=None, limit=100):
+
+        # Yield the items in `key` page by page (pages start at 1)
+        page = 1
+        received = 0
+        while True:
+            params = { "limit": limit, "page": page }
+            if fields:
+                params["field_mask"] = ','.join(fields)
+            (data, headers) = self.request("GET", path, params)
+            items = data.get(key, [])
+            yield from items
+            received += len(items)
+            total = int(headers.get("X-Total-Count") or 0)
+            if len(items) < limit or (total and received >= total):
+                break
+            page += 1
+
+    def end_devices(self, application_id, fields=None, limit=100):
+        path = f"/api/v3/applications/{urllib.parse.quote(application_id)}/devices"
+        return self.paginate(path, "end_devices", fields, limit)
+
+    def gateways(self, fields=None, limit=100):
+        return self.paginate("/api/v3/gateways", "gateways", fields, limit)
+
+    def _component(self, component, application_id, device_id, fields):
+
+        # Devices not registered in a component (ABP devices in the JS) come back as 404
+        path = f"/api/v3/{component}/applications/{urllib.parse.quote(application_id)}/devices/{urllib.parse.quote(device_id)}"
+        try:
+            return self.request("GET", path, { "field_mask": ','.join(fields) })[0]
+        except TTSError as err:
+            if 404 == err.status:
+                return {}
+            raise
+
+    def end_device(self, application_id, device_id, device=None):
+
+        # Root keys and session from the Join, Network and Application servers, in parallel
+        futures = [
+            self._executor.submit(self._component, component, application_id, device_id, fields)
+            for (component, fields) in [ ("js", JS_FIELDS), ("ns", NS_FIELDS), ("as", AS_FIELDS) ]
+        ]
+        output = dict(device or {})
+        for future in futures:
+            merge(output, future.result())
+        return output
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+def get_client(config):
+
+    # HTTP client unless the CLI is requested (or there is no API key to use with it)
+    mode = config.get('thethingsstack.client', 'auto')
+    apikey = config.get('thethingsstack.apikey')
+    if 'cli' == mode or ('auto' == mode and not apikey):
+        return None
+    if not apikey:
+        raise ValueError("The HTTP client requires an API key")
+    url = config.get('thethingsstack.url') or config.get('thethingsstack.host') or 'eu1.cloud.thethings.network'
+    return Client(url, apikey, int(config.get('thethingsstack.timeout', 10)), int(config.get('thethingsstack.workers', 8)))
@@ -1,3 +1,8 @@
+import os
+import json
+import signal
+import tempfile
+import threading
 import subprocess
 import pwinput
 
@@ -12,6 +17,18 @@ seconds_per_unit = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
 def convert_to_seconds(s):
     return int(s[:-1]) * seconds_per_unit[s[-1]]
 
+def kill(process):
+
+    # Kill the command and whatever it started (the shell does not always
+    # exec the command, killing only the shell leaves it running)
+    try:
+        if hasattr(os, 'killpg'):
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except (ProcessLookupError, PermissionError):
+        pass
+
 def shell(command, timeout=10):
         
     _process = subprocess.Popen(
@@ -21,13 +38,112 @@ def shell(command, timeout=10):
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
         close_fds=True,
+        start_new_session=hasattr(os, 'killpg'),
         # creationflags=DETACHED_PROCESS
     )
 
     try:
         stdout, stderr = _process.communicate(timeout=timeout)
     except Exception as e:
+        # Do not leave the process running (and reap it) before giving up
         print(f"ERROR: {str(e)}")
+        kill(_process)
+        _process.communicate()
         return[255, None]
 
     return [_process.returncode, stdout]
+
+def write_atomic(filename, content):
+
+    # Write to a temporary file in the same folder and rename it, readers
+    # never see a half written file
+    folder = os.path.dirname(os.path.abspath(filename))
+    fd, temp = tempfile.mkstemp(dir=folder, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, filename)
+    except Exception:
+        os.unlink(temp)
+        raise
+
+def json_items(stream, chunk_size=65536):
+
+    # Yield the elements of a JSON array as they are read from a text stream,
+    # only the element being parsed is kept in memory
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    started = False
+    finished = False
+    while not finished:
+        chunk = stream.read(chunk_size)
+        buffer = buffer[position:] + chunk
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+            if position == len(buffer):
+                break
+            if not started:
+                if "[" != buffer[position]:
+                    raise ValueError("Expected a JSON array")
+                started = True
+                position += 1
+                continue
+            if "]" == buffer[position]:
+                finished = True
+                break
+            try:
+                (item, position) = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # Element not complete yet, read more
+                if not chunk:
+                    raise
+                break
+            yield item
+        if not chunk and not finished:
+            if started:
+                raise ValueError("Unexpected end of JSON array")
+            return
+
+def shell_json(command, timeout=None):
+
+    # Run a command that outputs a JSON array and yield its elements while
+    # the output is being read, raises if the command fails
+    _process = subprocess.Popen(
+        command,
+        shell=True,
+        stdin=None,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        close_fds=True,
+        text=True,
+        start_new_session=hasattr(os, 'killpg'),
+    )
+    timer = None
+    expired = []
+    if timeout:
+        def expire():
+            expired.append(True)
+            kill(_process)
+        timer = threading.Timer(timeout, expire)
+        timer.start()
+    error = None
+    try:
+        yield from json_items(_process.stdout)
+    except ValueError as err:
+        error = err
+    finally:
+        if timer:
+            timer.cancel()
+        _process.stdout.close()
+        _process.wait()
+    if expired:
+        raise Exception(f"Command timed out after {timeout} seconds")
+    if not 0 == _process.returncode:
+        raise Exception(f"Command exited with code {_process.returncode}")
+    if error:
+        raise error
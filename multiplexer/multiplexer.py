@@ -1,49 +1,285 @@
 import os
 import sys
 
+import time
 import grpc
 import csv
+import json
+import hashlib
+import threading
 import yaml
 import argparse
 from chirpstack_api import api
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from common.config import Config
-from common.utils import get_pass, get_input, convert_to_seconds, shell
+from common.utils import get_pass, get_input, convert_to_seconds, shell, write_atomic
+from common.paginate import paginate
+from common.pool import ordered_map
 
 # -----------------------------------------------------------------------------
 # Methods
 # -----------------------------------------------------------------------------
 
-def get_tags(client, auth_token):
+def load_cache(filename):
 
-  tags = {}
+  # Tags of each gateway from the previous run, keyed by gateway_id
+  if not filename or not os.path.exists(filename):
+    return {}
+  try:
+    with open(filename) as f:
+      return json.load(f)
+  except Exception as err:
+    print("Error reading the tags cache, ignoring it", err)
+    return {}
 
-  # List gateways
-  req = api.ListGatewaysRequest()
-  req.limit = 10000
-  req.offset = 0
+def save_cache(filename, cache):
+
+  if not filename:
+    return
   try:
-    resp = client.List(req, metadata=auth_token)
+    write_atomic(filename, json.dumps(cache))
   except Exception as err:
-    print("Error getting the list of gateways", err)
-    return tags
+    print("Error writing the tags cache", err)
 
-  gateway_ids = [ gateway.gateway_id for gateway in resp.result ]
-  
-  for gateway_id in gateway_ids:
-    
-    # Get tags
+def get_tags(client, auth_token, page_size=1000, prefetch=False, workers=8, cache_file=None):
+
+  cache = load_cache(cache_file)
+  updated = {}
+
+  # Get tags, only for gateways that changed since they were cached
+  def get_gateway_tags(gateway):
+    updated_at = "%d.%09d" % (gateway.updated_at.seconds, gateway.updated_at.nanos)
+    cached = cache.get(gateway.gateway_id)
+    if cached and cached["updated_at"] == updated_at:
+      return (gateway.gateway_id, cached)
     req = api.GetGatewayRequest()
-    req.gateway_id = gateway_id
+    req.gateway_id = gateway.gateway_id
     try:
       resp = client.Get(req, metadata=auth_token)
     except Exception as err:
-      print("Error getting gateway data for gateway %s" % gateway_id, err)
+      print("Error getting gateway data for gateway %s" % gateway.gateway_id, err)
+      # Previous tags are better than moving the gateway to the default backends
+      return (gateway.gateway_id, cached)
+    return (gateway.gateway_id, { "updated_at": updated_at, "tags": dict(resp.gateway.tags) })
 
-    tags[gateway_id] = resp.gateway.tags
-    
-  return tags
+  # List gateways
+  list_req = api.ListGatewaysRequest()
+  try:
+    gateways = paginate(client.List, list_req, auth_token, page_size, prefetch)
+    for (gateway_id, entry) in ordered_map(get_gateway_tags, gateways, workers):
+      if entry:
+        updated[gateway_id] = entry
+  except Exception as err:
+    print("Error getting the list of gateways", err)
+    # Keep the entries of the gateways we could not list
+    updated = { **cache, **updated }
+
+  save_cache(cache_file, updated)
+  return dict([ (gateway_id, entry["tags"]) for (gateway_id, entry) in updated.items() ])
+
+def start_fetch(server, page_size=1000, prefetch=False, workers=8):
+
+  # Get the tags of one server in the background, daemon threads so a slow
+  # server does not keep the script from exiting
+  result = {}
+  def fetch():
+    result["tags"] = get_tags(server["client"], server["auth_token"], page_size, prefetch, workers, server["cache_file"])
+  thread = threading.Thread(target=fetch, daemon=True)
+  thread.start()
+  return (thread, result)
+
+def get_all_tags(servers, running, last, timeout, page_size=1000, prefetch=False, workers=8):
+
+  # Get the tags from all the servers concurrently. Servers that do not answer
+  # in time keep running in the background and their last known tags are used.
+  # For gateways in more than one server the first server in the list wins.
+  # Returns None if a server timed out and its gateways are not known yet
+  # (no cache), the output would leave them out. No timeout waits for all.
+  deadline = time.time() + timeout if timeout else None
+  for (index, server) in enumerate(servers):
+    if index not in running:
+      running[index] = start_fetch(server, page_size, prefetch, workers)
+
+  tags = {}
+  complete = True
+  for (index, server) in enumerate(servers):
+    (thread, result) = running[index]
+    thread.join(max(0, deadline - time.time()) if deadline else None)
+    if thread.is_alive():
+      if index not in last:
+        if not server["cache_file"] or not os.path.exists(server["cache_file"]):
+          print("Timeout getting the gateways from %s and no known ones yet" % server["name"])
+          complete = False
+          continue
+        last[index] = dict([ (gateway_id, entry["tags"]) for (gateway_id, entry) in load_cache(server["cache_file"]).items() ])
+      print("Timeout getting the gateways from %s, using the last known ones" % server["name"])
+    else:
+      del running[index]
+      last[index] = result.get("tags", {})
+
+    duplicates = 0
+    for (gateway_id, gateway_tags) in last[index].items():
+      if gateway_id in tags:
+        duplicates += 1
+      else:
+        tags[gateway_id] = gateway_tags
+    if duplicates:
+      print("Ignoring %d gateways from %s already defined in a previous server" % (duplicates, server["name"]))
+
+  return tags if complete else None
+
+def get_servers(config):
+
+  # List of servers (servers key) or the single server (server key)
+  servers = config.get('servers') or [ { "host": config.get('server.host', 'localhost:8080'), "api_token": config.get('server.api_token') } ]
+  cache_file = config.get('multiplexer.cache', 'multiplexer.cache')
+  output = []
+  for (index, server) in enumerate(servers):
+    output.append({
+      "name": server.get("name", server.get("host")),
+      # Connect without using TLS.
+      "client": api.GatewayServiceStub(grpc.insecure_channel(server.get("host", "localhost:8080"))),
+      # Define the API key meta-data.
+      "auth_token": [("authorization", "Bearer %s" % server.get("api_token"))],
+      "cache_file": get_indexed_file(cache_file, index, len(servers)) if cache_file else None,
+    })
+  return output
+
+def build_map(tags, default_backends):
+
+  # Filter and transverse 'packet-multiplexer' tag
+  map = {}
+  for eui in sorted(tags):
+    backends = []
+    if 'packet-multiplexer' in tags[eui]:
+      backends = tags[eui]['packet-multiplexer'].replace(',',' ').split()
+      backends = list(filter(None, backends))
+    if len(backends) == 0:
+      backends = default_backends
+    for backend in backends:
+      if not backend in map:
+        map[backend] = []
+      map[backend].append(eui)
+  return map
+
+def render_config(config, map, bind=None):
+
+  # Header
+  output = "[general]\n  log_level=%d\n\n[packet_multiplexer]\n  bind=\"%s\"\n" % (
+    config.get("log_level", 4), 
+    bind or config.get("multiplexer.bind", "0.0.0.0:1700")
+  )
+
+  # Backends
+  for backend in config.get('multiplexer.backends', {}).as_dict():
+    output += "\n[[packet_multiplexer.backend]]\n  host=\"%s\"\n  uplink_only=%s\n  gateway_ids=%s\n" % (
+      config.get(f"multiplexer.backends.{backend}.host"), 
+      str(config.get(f"multiplexer.backends.{backend}.uplink_only", True)).lower(), 
+      str(map.get(backend, [])).replace('\'', '"')
+    )
+
+  return output
+
+def get_shard(eui, shards):
+
+  # Rendezvous hashing: the shard with the highest score for the gateway wins,
+  # adding or removing a shard only moves the gateways of that shard
+  scores = [ hashlib.sha1(f"{shard}:{eui.lower()}".encode()).digest() for shard in range(shards) ]
+  return scores.index(max(scores))
+
+def split_map(map, shards):
+
+  # One backend -> gateways map per shard, a gateway goes to the same shard for all its backends
+  maps = [ {} for _ in range(shards) ]
+  for backend in map:
+    for eui in map[backend]:
+      maps[get_shard(eui, shards) if shards > 1 else 0].setdefault(backend, []).append(eui)
+  return maps
+
+def get_indexed_file(filename, index, count):
+  if 1 == count:
+    return filename
+  (base, extension) = os.path.splitext(filename)
+  return f"{base}-{index}{extension}"
+
+def get_shard_bind(bind, shard):
+  (host, port) = bind.rsplit(':', 1)
+  return f"{host}:{int(port) + shard}"
+
+def get_moves(old_map, new_map):
+
+  # Gateways whose backends changed, as (eui, old backends, new backends)
+  def by_gateway(map):
+    gateways = {}
+    for backend in sorted(map):
+      for eui in map[backend]:
+        gateways.setdefault(eui, []).append(backend)
+    return gateways
+  old = by_gateway(old_map)
+  new = by_gateway(new_map)
+  moves = []
+  for eui in sorted(set(old) | set(new)):
+    if old.get(eui, []) != new.get(eui, []):
+      moves.append((eui, old.get(eui, []), new.get(eui, [])))
+  return moves
+
+def write_config(filename, content):
+
+  # Write the file only if it changes
+  current = None
+  if os.path.exists(filename):
+    with open(filename) as f:
+      current = f.read()
+  if content == current:
+    return False
+  write_atomic(filename, content)
+  print("Configuration written to %s" % filename)
+  return True
+
+def update(config, map, previous=None, force=False):
+
+  # Write the config file of each shard and run the reload hook if any changed
+  # (or with force, when the last reload failed). Raises if the hook fails.
+  filename = config.get('multiplexer.configfile', 'chirpstack-packet-multiplexer.toml')
+  bind = config.get("multiplexer.bind", "0.0.0.0:1700")
+  shards = max(1, int(config.get('multiplexer.shards', 1)))
+
+  if previous is not None:
+    for (eui, old, new) in get_moves(previous, map):
+      print("Gateway %s moved from [%s] to [%s]" % (eui, ' '.join(old), ' '.join(new)))
+
+  changed = False
+  summary = []
+  for (shard, shard_map) in enumerate(split_map(map, shards)):
+    shard_file = get_indexed_file(filename, shard, shards)
+    shard_bind = get_shard_bind(bind, shard)
+    changed = write_config(shard_file, render_config(config, shard_map, shard_bind)) or changed
+    summary.append({
+      "shard": shard,
+      "configfile": shard_file,
+      "bind": shard_bind,
+      "gateways": len(set(sum(shard_map.values(), []))),
+      "backends": dict([ (backend, len(euis)) for (backend, euis) in sorted(shard_map.items()) ]),
+    })
+
+  # Load per shard
+  if shards > 1:
+    for item in summary:
+      print("Shard %d (%s): %d gateways, %s" % (item["shard"], item["bind"], item["gateways"], ', '.join([ f"{backend}: {count}" for (backend, count) in item["backends"].items() ])))
+    if changed:
+      write_atomic(config.get('multiplexer.summary', 'multiplexer-shards.json'), json.dumps(summary, indent=2))
+
+  if not changed and not force:
+    return False
+
+  command = config.get('multiplexer.reload_command')
+  if command:
+    (code, output) = shell(command, int(config.get('multiplexer.reload_timeout', 30)))
+    if 0 != code:
+      raise Exception("reload command failed (exit code %d)" % code)
+
+  return True
 
 # -----------------------------------------------------------------------------
 # Entry point
@@ -57,53 +293,64 @@ if __name__ == "__main__":
   # CLI arguments
   parser = argparse.ArgumentParser()
   parser.add_argument("--config", "-c", default="config.yml", help = "Configuration file")
+  parser.add_argument("--watch", "-w", action='store_true', help = "Keep polling the gateways and update the file when tags change")
   args = parser.parse_args()
 
   # Read configuration
   config = Config(file=args.config)
 
-  # Define the API key meta-data.
-  auth_token = [("authorization", "Bearer %s" % config.get('server.api_token'))]
-
-  # Connect without using TLS.
-  channel = grpc.insecure_channel(config.get('server.host', 'localhost:8080'))
+  # Servers to get the gateways from
+  servers = get_servers(config)
+  running = {}
+  last = {}
+  timeout = str(config.get('multiplexer.timeout', '60s'))
+  timeout = int(timeout) if timeout.isnumeric() else convert_to_seconds(timeout)
 
-  # Device-queue API client.
-  client = api.GatewayServiceStub(channel)
-
-  # Get the tags from the gateways
-  tags = get_tags(client, auth_token)
+  # Options to get the tags from the gateways
+  page_size = int(config.get('server.page_size', 1000))
+  prefetch = bool(config.get('server.prefetch', False))
+  workers = int(config.get('server.workers', 8))
 
   # Get default backends
   default_backends = config.get('multiplexer.default_backends', 'local').replace(',',' ').split()
 
-  # Filter and transverse 'packet-multiplexer' tag
-  map = {}
-  for eui in tags:
-    backends = []
-    if 'packet-multiplexer' in tags[eui]:
-      backends = tags[eui]['packet-multiplexer'].replace(',',' ').split()
-      backends = list(filter(None, backends))
-    if len(backends) == 0:
-      backends = default_backends
-    for backend in backends:
-      if not backend in map:
-        map[backend] = []
-      map[backend].append(eui)
+  # Single run, waits for every server (the timeout only applies to watch mode,
+  # a single run has no previous gateways in memory and the background
+  # requests would not outlive it to update the cache)
+  if not args.watch:
+    tags = get_all_tags(servers, running, last, None, page_size, prefetch, workers)
+    try:
+      if not update(config, build_map(tags, default_backends)):
+        print("No changes")
+    except Exception as err:
+      print("Error updating the configuration", err)
+      sys.exit(1)
+    sys.exit(0)
 
-  # Open file
-  with open(config.get('multiplexer.configfile', 'chirpstack-packet-multiplexer.toml'), "w") as f:
-
-    # Header
-    f.write("[general]\n  log_level=%d\n\n[packet_multiplexer]\n  bind=\"%s\"\n" % (
-      config.get("log_level", 4), 
-      config.get("multiplexer.bind", "0.0.0.0:1700")
-    ))
-
-    # Backends
-    for backend in config.get('multiplexer.backends', {}).as_dict():
-      f.write("\n[[packet_multiplexer.backend]]\n  host=\"%s\"\n  uplink_only=%s\n  gateway_ids=%s\n" % (
-        config.get(f"multiplexer.backends.{backend}.host"), 
-        str(config.get(f"multiplexer.backends.{backend}.uplink_only", True)).lower(), 
-        str(map.get(backend, [])).replace('\'', '"'))
-      )
+  # Watch mode, poll the gateways and update the file when the map changes
+  interval = str(config.get('multiplexer.interval', '30s'))
+  interval = int(interval) if interval.isnumeric() else convert_to_seconds(interval)
+  # The map is only taken as applied once the files are written and reloaded,
+  # a failed update is retried on the next poll
+  previous = None
+  failed = False
+  try:
+    while True:
+      start = time.time()
+      tags = get_all_tags(servers, running, last, timeout, page_size, prefetch, workers)
+      if tags is None:
+        print("Configuration not updated, the gateways of some server are missing")
+      else:
+        map = build_map(tags, default_backends)
+        if map != previous or failed:
+          try:
+            update(config, map, previous, failed)
+            (previous, failed) = (map, False)
+          except Exception as err:
+            print("Error updating the configuration", err)
+            failed = True
+      delay = start + interval - time.time()
+      if delay > 0:
+        time.sleep(delay)
+  except KeyboardInterrupt:
+    pass
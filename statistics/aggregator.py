@@ -0,0 +1,77 @@
+import bisect
+import operator
+from array import array
+
+# -----------------------------------------------------------------------------
+# Columnar aggregation of (field, hours, values) datasets
+# -----------------------------------------------------------------------------
+
+class Aggregator():
+
+  def __init__(self, first_hour=0, last_hour=0, series=False, windows=None):
+
+    # Fields (uplinks, f<frequency>, dr<datarate>) are mapped to a column
+    # index the first time they show up
+    self._fields = {}
+    self._totals = array('q')
+
+    # Optional per-hour series, one column of `last_hour - first_hour` hours per
+    # field (plain lists, slice updates on them are the fastest option in pure python)
+    self._first_hour = first_hour
+    self._hours = max(0, last_hour - first_hour) if series else 0
+    self._series = [] if series else None
+
+    # Optional narrower windows as (name, first hour), each with its own totals column
+    self._windows = [ (name, hour, array('q')) for (name, hour) in (windows or []) ]
+
+  def add(self, datasets):
+
+    # Fold in the datasets of one device
+    for (field, hours, values) in datasets:
+      index = self._fields.get(field)
+      if index is None:
+        index = len(self._totals)
+        self._fields[field] = index
+        self._totals.append(0)
+        for (name, hour, totals) in self._windows:
+          totals.append(0)
+        if self._series is not None:
+          self._series.append([0.0] * self._hours)
+      self._totals[index] += int(sum(values))
+      for (name, hour, totals) in self._windows:
+        # Hours come sorted, only the tail falls inside a narrower window
+        totals[index] += int(sum(values[bisect.bisect_left(hours, hour):]))
+      if self._series is not None and hours:
+        column = self._series[index]
+        start = hours[0] - self._first_hour
+        end = start + len(hours)
+        if 0 <= start and end <= self._hours and hours[-1] - hours[0] == len(hours) - 1:
+          # Consecutive hours (the usual case) are added as a whole slice
+          column[start:end] = map(operator.add, column[start:end], values)
+        else:
+          for (hour, value) in zip(hours, values):
+            slot = hour - self._first_hour
+            if 0 <= slot < self._hours:
+              column[slot] += value
+
+  def totals(self):
+
+    # Same as summing Counters: fields without uplinks are left out
+    return dict([ (field, self._totals[index]) for (field, index) in self._fields.items() if self._totals[index] > 0 ])
+
+  def windows(self):
+
+    # Totals of each window, in the same format
+    blocks = {}
+    for (name, hour, totals) in self._windows:
+      blocks[name] = dict([ (field, totals[index]) for (field, index) in self._fields.items() if totals[index] > 0 ])
+    return blocks
+
+  def series(self):
+
+    # Timestamps of each hour and the values per field
+    if self._series is None:
+      return None
+    hours = [ (self._first_hour + slot) * 3600 for slot in range(self._hours) ]
+    values = dict([ (field, [ int(value) for value in self._series[index] ]) for (field, index) in self._fields.items() ])
+    return { "hours": hours, "values": values }
@@ -0,0 +1,62 @@
+import time
+import random
+import argparse
+import collections, functools, operator
+
+from aggregator import Aggregator
+
+# -----------------------------------------------------------------------------
+# Micro-benchmark of the per-application aggregation
+# -----------------------------------------------------------------------------
+
+FREQUENCIES = [ "867100000", "867300000", "867500000", "867700000", "867900000", "868100000", "868300000", "868500000" ]
+DATARATES = [ "0", "1", "2", "3", "4", "5" ]
+
+def fake_devices(num_devices, hours):
+
+  # (field, hours, values) datasets as returned by get_metrics for each device
+  random.seed(0)
+  slots = list(range(hours))
+  for _ in range(num_devices):
+    datasets = [ ("uplinks", slots, [ float(random.randint(0, 12)) for _ in slots ]) ]
+    datasets += [ ("f" + frequency, slots, [ float(random.randint(0, 2)) for _ in slots ]) for frequency in FREQUENCIES ]
+    datasets += [ ("dr" + datarate, slots, [ float(random.randint(0, 2)) for _ in slots ]) for datarate in DATARATES ]
+    yield datasets
+
+def with_counters(devices):
+
+  # Previous approach: one dict per device, reduced with Counter additions
+  metrics = []
+  for datasets in devices:
+    metrics.append(dict([ (field, int(sum(values))) for (field, hours, values) in datasets ]))
+  return dict(functools.reduce(operator.add, map(collections.Counter, metrics)))
+
+def with_aggregator(devices, hours, series=False):
+  aggregator = Aggregator(0, hours, series)
+  for datasets in devices:
+    aggregator.add(datasets)
+  return aggregator.totals()
+
+# -----------------------------------------------------------------------------
+# Entry point
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--devices", "-n", type=int, default=10000, help = "Number of devices in the application")
+  parser.add_argument("--hours", type=int, default=24, help = "Hours in the window")
+  args = parser.parse_args()
+
+  print(f"Aggregating {args.devices} devices over {args.hours} hours")
+  devices = list(fake_devices(args.devices, args.hours))
+
+  for (name, method) in [
+    ("Counter reduce", lambda: with_counters(devices)),
+    ("Aggregator", lambda: with_aggregator(devices, args.hours)),
+    ("Aggregator + series", lambda: with_aggregator(devices, args.hours, True)),
+  ]:
+    start = time.perf_counter()
+    result = method()
+    elapsed = time.perf_counter() - start
+    print(f" * {name}: {round(elapsed, 3)}s ({result['uplinks']} uplinks)")
@@ -0,0 +1,181 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# -----------------------------------------------------------------------------
+# Prometheus / OpenMetrics exporter serving an in-memory snapshot
+# -----------------------------------------------------------------------------
+
+def escape(value):
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def labels(**kwargs):
+  return ','.join([ f'{key}="{escape(value)}"' for (key, value) in kwargs.items() ])
+
+class Snapshot():
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._records = {}
+    self._tenants = {}
+    self._updated = 0
+
+  def update(self, record):
+
+    # Replace the record of one application (or the gateways of a tenant)
+    with self._lock:
+      self._records[(record["tenant_id"], record.get("application_id", "gateways"))] = record
+      self._updated = record["timestamp"]
+
+  def retain(self, tenants, keys, keep=()):
+
+    # Drop tenants and applications that are gone, records of the tenants in
+    # `keep` (their applications could not be listed) are left as they are
+    with self._lock:
+      self._tenants = dict(tenants)
+      for key in list(self._records.keys()):
+        if key not in keys and key[0] not in keep:
+          del self._records[key]
+
+  def render(self):
+
+    with self._lock:
+      records = [ record for record in self._records.values() if "application_id" in record ]
+      gateways = [ record for record in self._records.values() if "gateways" == record.get("type") ]
+      tenants = dict([ (tenant, 0) for tenant in self._tenants.items() ])
+      updated = self._updated
+
+    lines = []
+    for record in records:
+      tenant = (record["tenant_id"], record["tenant_name"])
+      tenants[tenant] = tenants.get(tenant, 0) + 1
+
+    lines.append("# HELP chirpstack_tenants Number of tenants")
+    lines.append("# TYPE chirpstack_tenants gauge")
+    lines.append(f"chirpstack_tenants {len(tenants)}")
+
+    lines.append("# HELP chirpstack_applications Number of applications per tenant")
+    lines.append("# TYPE chirpstack_applications gauge")
+    for ((tenant_id, tenant_name), count) in tenants.items():
+      lines.append(f"chirpstack_applications{{{labels(tenant_id=tenant_id, tenant_name=tenant_name)}}} {count}")
+
+    lines.append("# HELP chirpstack_devices Number of devices per application")
+    lines.append("# TYPE chirpstack_devices gauge")
+    for record in records:
+      lines.append(f"chirpstack_devices{{{self._labels(record)}}} {record['num_devices']}")
+
+    lines.append("# HELP chirpstack_uplinks Uplinks per application in the configured window")
+    lines.append("# TYPE chirpstack_uplinks gauge")
+    for record in records:
+      if "uplinks" in record:
+        lines.append(f"chirpstack_uplinks{{{self._labels(record)}}} {record['uplinks']}")
+
+    lines.append("# HELP chirpstack_uplinks_per_frequency Uplinks per application and frequency in the configured window")
+    lines.append("# TYPE chirpstack_uplinks_per_frequency gauge")
+    for record in records:
+      for (field, value) in record.items():
+        if field.startswith("f") and field[1:].isdigit():
+          lines.append(f"chirpstack_uplinks_per_frequency{{{self._labels(record, frequency=field[1:])}}} {value}")
+
+    lines.append("# HELP chirpstack_uplinks_per_dr Uplinks per application and data rate in the configured window")
+    lines.append("# TYPE chirpstack_uplinks_per_dr gauge")
+    for record in records:
+      for (field, value) in record.items():
+        if field.startswith("dr") and field[2:].isdigit():
+          lines.append(f"chirpstack_uplinks_per_dr{{{self._labels(record, dr=field[2:])}}} {value}")
+
+    lines.append("# HELP chirpstack_window_uplinks Uplinks per application in each of the configured windows")
+    lines.append("# TYPE chirpstack_window_uplinks gauge")
+    for record in records:
+      for (window, totals) in record.get("windows", {}).items():
+        if "uplinks" in totals:
+          lines.append(f"chirpstack_window_uplinks{{{self._labels(record, window=window)}}} {totals['uplinks']}")
+
+    lines.append("# HELP chirpstack_window_uplinks_per_frequency Uplinks per application and frequency in each of the configured windows")
+    lines.append("# TYPE chirpstack_window_uplinks_per_frequency gauge")
+    for record in records:
+      for (window, totals) in record.get("windows", {}).items():
+        for (field, value) in totals.items():
+          if field.startswith("f") and field[1:].isdigit():
+            lines.append(f"chirpstack_window_uplinks_per_frequency{{{self._labels(record, window=window, frequency=field[1:])}}} {value}")
+
+    lines.append("# HELP chirpstack_window_uplinks_per_dr Uplinks per application and data rate in each of the configured windows")
+    lines.append("# TYPE chirpstack_window_uplinks_per_dr gauge")
+    for record in records:
+      for (window, totals) in record.get("windows", {}).items():
+        for (field, value) in totals.items():
+          if field.startswith("dr") and field[2:].isdigit():
+            lines.append(f"chirpstack_window_uplinks_per_dr{{{self._labels(record, window=window, dr=field[2:])}}} {value}")
+
+    lines.append("# HELP chirpstack_gateways Number of gateways per tenant")
+    lines.append("# TYPE chirpstack_gateways gauge")
+    for record in gateways:
+      lines.append(f"chirpstack_gateways{{{self._tenant_labels(record)}}} {record['num_gateways']}")
+
+    for direction in [ "rx", "tx" ]:
+      lines.append(f"# HELP chirpstack_gateway_{direction}_packets Packets {'received' if 'rx' == direction else 'sent'} by the gateways of each tenant in the configured window")
+      lines.append(f"# TYPE chirpstack_gateway_{direction}_packets gauge")
+      for record in gateways:
+        lines.append(f"chirpstack_gateway_{direction}_packets{{{self._tenant_labels(record)}}} {record.get(direction + '_packets', 0)}")
+
+    lines.append("# HELP chirpstack_gateway_packets_per_frequency Packets per tenant, direction and frequency in the configured window")
+    lines.append("# TYPE chirpstack_gateway_packets_per_frequency gauge")
+    for record in gateways:
+      for (field, value) in record.items():
+        if field[:4] in [ "rx_f", "tx_f" ] and field[4:].isdigit():
+          lines.append(f"chirpstack_gateway_packets_per_frequency{{{self._tenant_labels(record, direction=field[:2], frequency=field[4:])}}} {value}")
+
+    lines.append("# HELP chirpstack_gateway_packets_per_dr Packets per tenant, direction and data rate in the configured window")
+    lines.append("# TYPE chirpstack_gateway_packets_per_dr gauge")
+    for record in gateways:
+      for (field, value) in record.items():
+        if field[:5] in [ "rx_dr", "tx_dr" ] and field[5:].isdigit():
+          lines.append(f"chirpstack_gateway_packets_per_dr{{{self._tenant_labels(record, direction=field[:2], dr=field[5:])}}} {value}")
+
+    lines.append("# HELP chirpstack_window_gateway_packets Packets per tenant and direction in each of the configured windows")
+    lines.append("# TYPE chirpstack_window_gateway_packets gauge")
+    for record in gateways:
+      for (window, totals) in record.get("windows", {}).items():
+        for direction in [ "rx", "tx" ]:
+          if direction + "_packets" in totals:
+            lines.append(f"chirpstack_window_gateway_packets{{{self._tenant_labels(record, window=window, direction=direction)}}} {totals[direction + '_packets']}")
+
+    lines.append("# HELP chirpstack_statistics_updated_timestamp_seconds Time of the last application refresh")
+    lines.append("# TYPE chirpstack_statistics_updated_timestamp_seconds gauge")
+    lines.append(f"chirpstack_statistics_updated_timestamp_seconds {updated}")
+
+    return '\n'.join(lines) + '\n'
+
+  def _tenant_labels(self, record, **kwargs):
+    return labels(tenant_id=record["tenant_id"], tenant_name=record["tenant_name"], **kwargs)
+
+  def _labels(self, record, **kwargs):
+    return labels(
+      tenant_id=record["tenant_id"], tenant_name=record["tenant_name"],
+      application_id=record["application_id"], application_name=record["application_name"],
+      **kwargs
+    )
+
+def serve(snapshot, bind="0.0.0.0:9100"):
+
+  # Scrapes only read the snapshot, they never reach the ChirpStack API
+  class Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+      if self.path.split('?')[0] != "/metrics":
+        self.send_error(404)
+        return
+      body = snapshot.render().encode('utf-8')
+      self.send_response(200)
+      self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message(self, format, *args):
+      pass
+
+  (host, port) = bind.rsplit(':', 1)
+  server = ThreadingHTTPServer((host, int(port)), Handler)
+  thread = threading.Thread(target=server.serve_forever, daemon=True)
+  thread.start()
+  return server
@@ -0,0 +1,71 @@
+import sqlite3
+import threading
+
+# -----------------------------------------------------------------------------
+# Local cache of the hourly link metrics buckets of each device
+# -----------------------------------------------------------------------------
+
+class MetricsCache():
+
+  def __init__(self, filename):
+
+    self._lock = threading.Lock()
+    self._db = sqlite3.connect(filename, check_same_thread=False)
+    self._db.execute("PRAGMA journal_mode=WAL")
+    self._db.execute("PRAGMA synchronous=NORMAL")
+
+    # Buckets hold the values, hours flag which (complete) hours have already
+    # been fetched so hours without traffic are not requested again
+    self._db.execute("CREATE TABLE IF NOT EXISTS buckets (dev_eui TEXT, hour INTEGER, field TEXT, value REAL, PRIMARY KEY (dev_eui, hour, field))")
+    self._db.execute("CREATE TABLE IF NOT EXISTS hours (dev_eui TEXT, hour INTEGER, PRIMARY KEY (dev_eui, hour))")
+    # Eviction goes by hour, the keys start with the device
+    self._db.execute("CREATE INDEX IF NOT EXISTS buckets_hour ON buckets (hour)")
+    self._db.execute("CREATE INDEX IF NOT EXISTS hours_hour ON hours (hour)")
+    self._db.commit()
+
+  def first_missing(self, dev_eui, first_hour, last_hour):
+
+    # First hour in [first_hour, last_hour) not in the cache, last_hour if none
+    with self._lock:
+      rows = self._db.execute("SELECT hour FROM hours WHERE dev_eui = ? AND hour >= ? AND hour < ?", (dev_eui, first_hour, last_hour)).fetchall()
+    cached = set([ row[0] for row in rows ])
+    for hour in range(first_hour, last_hour):
+      if hour not in cached:
+        return hour
+    return last_hour
+
+  def store(self, dev_eui, datasets, first_hour, last_hour):
+
+    # Save the values of the datasets in [first_hour, last_hour) and flag those hours as fetched
+    rows = []
+    for (field, hours, values) in datasets:
+      rows += [ (dev_eui, hour, field, value) for (hour, value) in zip(hours, values) if first_hour <= hour < last_hour ]
+    with self._lock:
+      self._db.executemany("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?)", rows)
+      self._db.executemany("INSERT OR REPLACE INTO hours VALUES (?, ?)", [ (dev_eui, hour) for hour in range(first_hour, last_hour) ])
+      self._db.commit()
+
+  def datasets(self, dev_eui, first_hour, last_hour):
+
+    # Cached values in [first_hour, last_hour) as (field, hours, values) datasets
+    with self._lock:
+      rows = self._db.execute("SELECT field, hour, value FROM buckets WHERE dev_eui = ? AND hour >= ? AND hour < ? ORDER BY hour, rowid", (dev_eui, first_hour, last_hour)).fetchall()
+    datasets = {}
+    for (field, hour, value) in rows:
+      if field not in datasets:
+        datasets[field] = (field, [], [])
+      datasets[field][1].append(hour)
+      datasets[field][2].append(value)
+    return list(datasets.values())
+
+  def evict(self, first_hour):
+
+    # Drop everything older than first_hour
+    with self._lock:
+      self._db.execute("DELETE FROM buckets WHERE hour < ?", (first_hour, ))
+      self._db.execute("DELETE FROM hours WHERE hour < ?", (first_hour, ))
+      self._db.commit()
+
+  def close(self):
+    with self._lock:
+      self._db.close()
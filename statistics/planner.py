@@ -0,0 +1,34 @@
+import threading
+
+# -----------------------------------------------------------------------------
+# Skip the link metrics requests of devices and gateways that cannot have any
+# -----------------------------------------------------------------------------
+
+class Planner():
+
+  def __init__(self, enabled=True):
+
+    self._enabled = enabled
+    self._lock = threading.Lock()
+    self.devices = 0
+    self.skipped = 0
+
+  def is_dormant(self, device, first_hour):
+
+    # Devices not seen since before the window cannot have uplinks in it
+    with self._lock:
+      self.devices += 1
+    if not self._enabled:
+      return False
+    last_seen = device.last_seen_at.seconds if device.HasField("last_seen_at") else 0
+    if last_seen >= first_hour * 3600:
+      return False
+    with self._lock:
+      self.skipped += 1
+    return True
+
+  def summary(self):
+
+    # Every device and gateway not skipped takes a single request
+    with self._lock:
+      return f"Planner: {self.devices} devices and gateways, {self.skipped} dormant ones skipped, {self.devices - self.skipped} metrics requests"
@@ -0,0 +1,126 @@
+import json
+
+try:
+  import pyarrow
+  import pyarrow.ipc
+  import pyarrow.parquet
+except ImportError:
+  pyarrow = None
+
+# -----------------------------------------------------------------------------
+# Output sinks, records are written as they come so memory does not grow with
+# the number of tenants and applications
+# -----------------------------------------------------------------------------
+
+class JsonSink():
+
+  # One JSON array with a record per application
+  series = False
+
+  def __init__(self, filename):
+    self._file = open(filename, "w")
+    self._file.write('[')
+    self._lines = 0
+
+  def write(self, record):
+    if not 0 == self._lines:
+      self._file.write(',')
+    self._file.write('\n')
+    self._file.write(json.dumps(record))
+    self._lines += 1
+
+  def close(self):
+    self._file.write('\n]\n')
+    self._file.close()
+
+class NdjsonSink():
+
+  # One JSON record per line
+  series = False
+
+  def __init__(self, filename):
+    self._file = open(filename, "w")
+
+  def write(self, record):
+    self._file.write(json.dumps(record))
+    self._file.write('\n')
+
+  def close(self):
+    self._file.close()
+
+class ArrowSink():
+
+  # Columnar file (Parquet or Arrow IPC) with one row per application, hour and field,
+  # gateway records have no application
+  series = True
+  columns = [ "timestamp", "tenant_id", "tenant_name", "application_id", "application_name", "hour", "metric", "label", "value" ]
+
+  def __init__(self, filename, format="parquet", batch_size=65536):
+
+    if pyarrow is None:
+      raise RuntimeError(f"The {format} output requires the pyarrow package (pip install pyarrow)")
+
+    self._schema = pyarrow.schema([
+      ("timestamp", pyarrow.timestamp("s", tz="UTC")),
+      ("tenant_id", pyarrow.string()),
+      ("tenant_name", pyarrow.string()),
+      ("application_id", pyarrow.string()),
+      ("application_name", pyarrow.string()),
+      ("hour", pyarrow.timestamp("s", tz="UTC")),
+      ("metric", pyarrow.string()),
+      ("label", pyarrow.string()),
+      ("value", pyarrow.int64()),
+    ])
+    if "parquet" == format:
+      self._writer = pyarrow.parquet.ParquetWriter(filename, self._schema)
+    else:
+      self._writer = pyarrow.ipc.new_file(filename, self._schema)
+    self._batch_size = batch_size
+    self._rows = dict([ (column, []) for column in self.columns ])
+    self._count = 0
+
+  def write(self, record):
+
+    series = record.get("series")
+    if not series:
+      return
+
+    keys = [ record.get(column) for column in self.columns[:5] ]
+    for (field, values) in series["values"].items():
+      # Gateway fields come with an rx_ / tx_ direction prefix
+      direction = ""
+      if field[:3] in [ "rx_", "tx_" ] and not field.endswith("_packets"):
+        (direction, field) = (field[:3], field[3:])
+      if field.startswith("dr"):
+        (metric, label) = (direction + "dr", field[2:])
+      elif field.startswith("f"):
+        (metric, label) = (direction + "frequency", field[1:])
+      else:
+        (metric, label) = (field, "")
+      for (hour, value) in zip(series["hours"], values):
+        for (column, item) in zip(self.columns, keys + [ hour, metric, label, value ]):
+          self._rows[column].append(item)
+        self._count += 1
+
+    if self._count >= self._batch_size:
+      self._flush()
+
+  def _flush(self):
+    if self._count:
+      self._writer.write_batch(pyarrow.record_batch(self._rows, schema=self._schema))
+      self._rows = dict([ (column, []) for column in self.columns ])
+      self._count = 0
+
+  def close(self):
+    self._flush()
+    self._writer.close()
+
+def get_sink(format, filename):
+
+  if "json" == format:
+    return JsonSink(filename)
+  if "ndjson" == format:
+    return NdjsonSink(filename)
+  if format in [ "parquet", "arrow" ]:
+    return ArrowSink(filename, format)
+  raise ValueError(f"Unknown output format '{format}'")
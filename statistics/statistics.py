@@ -2,87 +2,344 @@ import os
 import sys
 
 import grpc
-import json
+import time
 import argparse
 from datetime import datetime
 
 from chirpstack_api import api
-import collections, functools, operator
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from common.config import Config
 from common.utils import get_pass, get_input, convert_to_seconds, shell
+from common.pool import ordered_map
+from common.paginate import paginate
+from metrics_cache import MetricsCache
+from aggregator import Aggregator
+from sinks import get_sink
+from exporter import Snapshot, serve
+from planner import Planner
 
 # -----------------------------------------------------------------------------
 # Methods
 # -----------------------------------------------------------------------------
 
-def get_tenants(channel, auth_token):
+def list_tenants(channel, auth_token, page_size=1000, prefetch=False):
 
   client = api.TenantServiceStub(channel)
   req = api.ListTenantsRequest()
-  req.limit = 10000
-  req.offset = 0
+  for tenant in paginate(client.List, req, auth_token, page_size, prefetch):
+    yield (tenant.id, tenant.name)
+
+def get_tenants(channel, auth_token, page_size=1000, prefetch=False):
+
   try:
-    resp = client.List(req, metadata=auth_token)
+    yield from list_tenants(channel, auth_token, page_size, prefetch)
   except Exception as err:
     print(f"Error getting the list of tenants ({str(err)})")
-    return {}
 
-  tenants = dict([ (tenant.id, tenant.name) for tenant in resp.result ])
-  return tenants
-
-def get_applications(channel, auth_token, tenant_id):
+def list_applications(channel, auth_token, tenant_id, page_size=1000, prefetch=False):
 
   client = api.ApplicationServiceStub(channel)
   req = api.ListApplicationsRequest()
-  req.limit = 10000
-  req.offset = 0
   req.tenant_id = tenant_id
+  for application in paginate(client.List, req, auth_token, page_size, prefetch):
+    yield (application.id, application.name)
+
+def get_applications(channel, auth_token, tenant_id, page_size=1000, prefetch=False):
+
   try:
-    resp = client.List(req, metadata=auth_token)
+    yield from list_applications(channel, auth_token, tenant_id, page_size, prefetch)
   except Exception as err:
     print(f"Error getting the list of applications for tenant {tenant_id} ({str(err)})")
-    return {}
-
-  applications = dict([ (application.id, application.name) for application in resp.result ])
-  return applications
 
-def get_devices(channel, auth_token, application_id):
+def list_devices(channel, auth_token, application_id, page_size=1000, prefetch=False):
 
   client = api.DeviceServiceStub(channel)
   req = api.ListDevicesRequest()
-  req.limit = 10000
-  req.offset = 0
   req.application_id = application_id
+  yield from paginate(client.List, req, auth_token, page_size, prefetch)
+
+def get_devices(channel, auth_token, application_id, page_size=1000, prefetch=False):
+
   try:
-    resp = client.List(req, metadata=auth_token)
+    yield from list_devices(channel, auth_token, application_id, page_size, prefetch)
   except Exception as err:
     print(f"Error getting the list of devices for application {application_id} ({str(err)})")
-    return {}
 
-  devices = [ device.dev_eui for device in resp.result ]
-  return devices
+def list_gateways(channel, auth_token, tenant_id, page_size=1000, prefetch=False):
 
-def get_metrics(channel, auth_token, device_id, hours=24):
+  client = api.GatewayServiceStub(channel)
+  req = api.ListGatewaysRequest()
+  req.tenant_id = tenant_id
+  yield from paginate(client.List, req, auth_token, page_size, prefetch)
+
+def get_gateways(channel, auth_token, tenant_id, page_size=1000, prefetch=False):
+
+  try:
+    yield from list_gateways(channel, auth_token, tenant_id, page_size, prefetch)
+  except Exception as err:
+    print(f"Error getting the list of gateways for tenant {tenant_id} ({str(err)})")
+
+def get_datasets(metrics):
+
+  # Flatten (metric, field, prefix) tuples into (field, hours, values) datasets,
+  # datasets are named after the field or the prefix plus their label
+  for (metric, field, prefix) in metrics:
+    hours = [ timestamp.seconds // 3600 for timestamp in metric.timestamps ]
+    for dataset in metric.datasets:
+      yield (field or prefix + dataset.label, hours, list(dataset.data))
+
+def get_link_metrics(client, auth_token, device_id, start, end):
 
-  client = api.DeviceServiceStub(channel)
   req = api.GetDeviceLinkMetricsRequest()
   req.dev_eui = device_id
-  req.start.seconds = int(datetime.now().timestamp() - 60*60*hours)
-  req.end.seconds = int(datetime.now().timestamp())
+  req.start.seconds = start
+  req.end.seconds = end
+  req.aggregation = 0 # 0: hour, 1: day, 2: month
+  return client.GetLinkMetrics(req, metadata=auth_token)
+
+def get_gateway_link_metrics(client, auth_token, gateway_id, start, end):
+
+  req = api.GetGatewayMetricsRequest()
+  req.gateway_id = gateway_id
+  req.start.seconds = start
+  req.end.seconds = end
   req.aggregation = 0 # 0: hour, 1: day, 2: month
+  return client.GetMetrics(req, metadata=auth_token)
+
+def get_metrics(channel, auth_token, device, hours=24, cache=None, planner=None):
+
+  # The window spans the current (partial) hour and the previous `hours` ones,
+  # complete hours already in the cache are not requested again
+  device_id = device.dev_eui
+  now = int(datetime.now().timestamp())
+  current_hour = now // 3600
+  first_hour = current_hour - hours
+  start_hour = first_hour
+
+  # No uplinks in the window, no need to ask
+  if planner and planner.is_dormant(device, first_hour):
+    return []
+
+  if cache:
+    start_hour = cache.first_missing(device_id, first_hour, current_hour)
+
+  # Several windows are derived from the hourly buckets of a single request
+  client = api.DeviceServiceStub(channel)
   try:
-    resp = client.GetLinkMetrics(req, metadata=auth_token)
+    resp = get_link_metrics(client, auth_token, device_id, start_hour * 3600, now)
   except Exception as err:
     print(f"Error getting the metrics from device {device_id} ({str(err)})")
-    return {}
+    return None
+
+  datasets = list(get_datasets([ (resp.rx_packets, "uplinks", None), (resp.rx_packets_per_freq, None, "f"), (resp.rx_packets_per_dr, None, "dr") ]))
+
+  if cache:
+    cache.store(device_id, datasets, start_hour, current_hour)
+    datasets = cache.datasets(device_id, first_hour, start_hour) + datasets
+
+  return datasets
+
+def get_gateway_metrics(channel, auth_token, gateway, hours=24, planner=None):
+
+  # Same window as the devices, without cache
+  gateway_id = gateway.gateway_id
+  now = int(datetime.now().timestamp())
+  current_hour = now // 3600
+  first_hour = current_hour - hours
 
-  fields = []
-  fields += [ ("uplinks", int(sum(dataset.data))) for dataset in resp.rx_packets.datasets ]
-  fields += [ ("f"+dataset.label, int(sum(dataset.data))) for dataset in resp.rx_packets_per_freq.datasets ]
-  fields += [ ("dr"+dataset.label, int(sum(dataset.data))) for dataset in resp.rx_packets_per_dr.datasets ]
-  return dict(fields)
+  if planner and planner.is_dormant(gateway, first_hour):
+    return []
+
+  client = api.GatewayServiceStub(channel)
+  try:
+    resp = get_gateway_link_metrics(client, auth_token, gateway_id, first_hour * 3600, now)
+  except Exception as err:
+    print(f"Error getting the metrics from gateway {gateway_id} ({str(err)})")
+    return None
+
+  return list(get_datasets([
+    (resp.rx_packets, "rx_packets", None), (resp.tx_packets, "tx_packets", None),
+    (resp.rx_packets_per_freq, None, "rx_f"), (resp.tx_packets_per_freq, None, "tx_f"),
+    (resp.rx_packets_per_dr, None, "rx_dr"), (resp.tx_packets_per_dr, None, "tx_dr"),
+  ]))
+
+def get_application_stats(channel, auth_token, config, tenant, application, cache=None, series=False, now=None, planner=None, strict=False):
+
+  # Record with the device count and uplink totals of one application,
+  # with strict a failure listing the devices raises instead of counting
+  # only the ones listed so far
+  (tenant_id, tenant_name) = tenant
+  (application_id, application_name) = application
+  page_size = int(config.get("server.page_size", "1000"))
+  prefetch = bool(config.get("server.prefetch", False))
+
+  devices = (list_devices if strict else get_devices)(channel, auth_token, application_id, page_size, prefetch)
+  num_devices = 0
+  aggregator = None
+
+  if bool(config.get("uplinks.enabled", True)):
+    windows = get_windows(config)
+    hours = get_hours(config)
+    workers = int(config.get("uplinks.workers", "8"))
+    series = series or bool(config.get("uplinks.series", False))
+    current_hour = int(datetime.now().timestamp()) // 3600
+    aggregator = Aggregator(current_hour - hours, current_hour + 1, series, [ (name, current_hour - window) for (name, window) in windows ])
+    failed = 0
+    for datasets in ordered_map(lambda device: get_metrics(channel, auth_token, device, hours, cache, planner), devices, workers):
+      num_devices += 1
+      if datasets is None:
+        failed += 1
+      else:
+        aggregator.add(datasets)
+    if failed:
+      print(f"Could not get metrics for {failed} out of {num_devices} devices in application {application_id}")
+  else:
+    num_devices = sum(1 for device in devices)
+
+  headers = ["timestamp", "tenant_id", "tenant_name", "application_id", "application_name", "num_devices"]
+  data = [ now or int(datetime.now().timestamp()), tenant_id, tenant_name, application_id, application_name, num_devices ]
+  output = dict(zip(headers, data))
+  if aggregator:
+    output.update(aggregator.totals())
+    windows = aggregator.windows()
+    if windows:
+      output["windows"] = windows
+    series = aggregator.series()
+    if series:
+      output["series"] = series
+
+  return output
+
+def get_gateway_stats(channel, auth_token, config, tenant, series=False, now=None, planner=None, strict=False):
+
+  # Record with the gateway count and RX/TX totals of one tenant, strict
+  # works like in get_application_stats
+  (tenant_id, tenant_name) = tenant
+  page_size = int(config.get("server.page_size", "1000"))
+  prefetch = bool(config.get("server.prefetch", False))
+
+  windows = get_windows(config)
+  hours = get_hours(config)
+  workers = int(config.get("gateways.workers", "8"))
+  series = series or bool(config.get("uplinks.series", False))
+  current_hour = int(datetime.now().timestamp()) // 3600
+  aggregator = Aggregator(current_hour - hours, current_hour + 1, series, [ (name, current_hour - window) for (name, window) in windows ])
+
+  gateways = (list_gateways if strict else get_gateways)(channel, auth_token, tenant_id, page_size, prefetch)
+  num_gateways = 0
+  failed = 0
+  for datasets in ordered_map(lambda gateway: get_gateway_metrics(channel, auth_token, gateway, hours, planner), gateways, workers):
+    num_gateways += 1
+    if datasets is None:
+      failed += 1
+    else:
+      aggregator.add(datasets)
+  if failed:
+    print(f"Could not get metrics for {failed} out of {num_gateways} gateways in tenant {tenant_id}")
+
+  headers = ["type", "timestamp", "tenant_id", "tenant_name", "num_gateways"]
+  data = [ "gateways", now or int(datetime.now().timestamp()), tenant_id, tenant_name, num_gateways ]
+  output = dict(zip(headers, data))
+  output.update(aggregator.totals())
+  windows = aggregator.windows()
+  if windows:
+    output["windows"] = windows
+  series = aggregator.series()
+  if series:
+    output["series"] = series
+
+  return output
+
+def get_windows(config):
+
+  # Windows as (name, hours), like 1h, 24h, 7d or a number of hours
+  windows = []
+  for window in config.get("uplinks.windows", []) or []:
+    window = str(window)
+    windows.append((window, int(window) if window.isnumeric() else convert_to_seconds(window) // 3600))
+  return windows
+
+def get_hours(config):
+
+  # Hours to request, the widest window if several are defined
+  windows = get_windows(config)
+  if windows:
+    return max([ hours for (name, hours) in windows ])
+  return int(config.get("uplinks.hours", "24"))
+
+def get_planner(config):
+  return Planner(bool(config.get("uplinks.planner", True)))
+
+def run_daemon(channel, auth_token, config, cache=None):
+
+  # Keep refreshing the snapshot served on /metrics, applications are spread
+  # evenly over the interval so the load on the server stays flat
+  snapshot = Snapshot()
+  bind = config.get("daemon.bind", "0.0.0.0:9100")
+  serve(snapshot, bind)
+  print(f"Serving metrics on http://{bind}/metrics")
+
+  interval = str(config.get("daemon.interval", "5m"))
+  interval = int(interval) if interval.isnumeric() else convert_to_seconds(interval)
+  page_size = int(config.get("server.page_size", "1000"))
+  prefetch = bool(config.get("server.prefetch", False))
+
+  while True:
+
+    start = time.time()
+
+    # If a listing fails the last good records are kept (all of them, or the
+    # ones of that tenant) instead of dropping them from /metrics
+    listed = True
+    try:
+      tenants = dict(list_tenants(channel, auth_token, page_size, prefetch))
+    except Exception as err:
+      print(f"Error getting the list of tenants, keeping the last metrics ({str(err)})")
+      (tenants, listed) = ({}, False)
+    applications = []
+    failed = set()
+    for tenant in tenants.items():
+      try:
+        applications += [ (tenant, application) for application in list_applications(channel, auth_token, tenant[0], page_size, prefetch) ]
+      except Exception as err:
+        print(f"Error getting the list of applications for tenant {tenant[0]}, keeping the last metrics ({str(err)})")
+        failed.add(tenant[0])
+        continue
+      # The gateways of each tenant are refreshed like one more application
+      if bool(config.get("gateways.enabled", False)):
+        applications.append((tenant, None))
+
+    planner = get_planner(config)
+    step = interval / max(1, len(applications))
+    for (index, (tenant, application)) in enumerate(applications):
+      delay = start + index * step - time.time()
+      if delay > 0:
+        time.sleep(delay)
+      # Same for the devices or gateways, the record is only replaced if
+      # they could all be listed
+      if application is None:
+        try:
+          snapshot.update(get_gateway_stats(channel, auth_token, config, tenant, planner=planner, strict=True))
+        except Exception as err:
+          print(f"Error getting the list of gateways for tenant {tenant[0]}, keeping the last metrics ({str(err)})")
+        continue
+      try:
+        snapshot.update(get_application_stats(channel, auth_token, config, tenant, application, cache, planner=planner, strict=True))
+      except Exception as err:
+        print(f"Error getting the list of devices for application {application[0]}, keeping the last metrics ({str(err)})")
+
+    # Old buckets are dropped once per cycle
+    if cache:
+      cache.evict(int(time.time()) // 3600 - get_hours(config))
+
+    if listed:
+      snapshot.retain(tenants, set([ (tenant[0], application[0] if application else "gateways") for (tenant, application) in applications ]), failed)
+    print(planner.summary())
+
+    delay = start + interval - time.time()
+    if delay > 0:
+      time.sleep(delay)
 
 # -----------------------------------------------------------------------------
 # Entry point
@@ -91,11 +348,12 @@ def get_metrics(channel, auth_token, device_id, hours=24):
 if __name__ == "__main__":
     
   # Hello
-  print("Getting metrics from tenants, applications and devices")
+  print("Getting metrics from tenants, applications, devices and gateways")
 
   # CLI arguments
   parser = argparse.ArgumentParser()
   parser.add_argument("--config", "-c", default="config.yml", help = "Configuration file")
+  parser.add_argument("--daemon", "-d", action='store_true', help = "Keep running and serve the metrics over HTTP")
   args = parser.parse_args()
 
   # Read configuration
@@ -110,48 +368,43 @@ if __name__ == "__main__":
   # Current timestamp
   now = int(datetime.now().timestamp())
 
-  # Header
-  headers = ["timestamp", "tenant_id", "tenant_name", "application_id", "application_name", "num_devices"]
-
-  # Open filename
-  with open(config.get('filename', 'stats.json'), "w") as f:
-
-    # Start array
-    f.write('[')
-
-    # Get Tenants
-    tenants = get_tenants(channel, auth_token)
-
-    # Lines
-    line = 0
-
-    # Applications
-    for tenant in tenants:
-      
-      applications = get_applications(channel, auth_token, tenant)
-      for application in applications:
-        
-        devices = get_devices(channel, auth_token, application)
-        data = [ now, tenant, tenants[tenant], application, applications[application], len(devices) ]
-        output = dict(zip(headers, data))
-
-        if bool(config.get("uplinks.enabled", True)):
-          hours = int(config.get("uplinks.hours", "24"))
-          metrics = []
-          for device in devices:
-            metrics.append(get_metrics(channel, auth_token, device, hours))
-          if metrics:
-            result = dict(functools.reduce(operator.add, map(collections.Counter, metrics)))
-            output.update(result)
-        
-        if not 0 == line:
-          f.write(',')
-        f.write('\n')
-        f.write(json.dumps(output))
-
-        line += 1
-
-    # End array
-    f.write('\n]\n')
-
-
+  # Paging
+  page_size = int(config.get("server.page_size", "1000"))
+  prefetch = bool(config.get("server.prefetch", False))
+
+  # Local cache of hourly buckets
+  cache = None
+  if config.get("uplinks.cache"):
+    cache = MetricsCache(config.get("uplinks.cache"))
+    cache.evict(now // 3600 - get_hours(config))
+
+  # Daemon mode
+  if args.daemon:
+    try:
+      run_daemon(channel, auth_token, config, cache)
+    except KeyboardInterrupt:
+      pass
+    if cache:
+      cache.close()
+    sys.exit(0)
+
+  # Open output
+  try:
+    sink = get_sink(config.get('format', 'json'), config.get('filename', 'stats.json'))
+  except Exception as err:
+    print(f"Error opening the output ({str(err)})")
+    sys.exit(1)
+
+  # Applications
+  planner = get_planner(config)
+  for tenant in get_tenants(channel, auth_token, page_size, prefetch):
+    for application in get_applications(channel, auth_token, tenant[0], page_size, prefetch):
+      sink.write(get_application_stats(channel, auth_token, config, tenant, application, cache, sink.series, now, planner))
+    if bool(config.get("gateways.enabled", False)):
+      sink.write(get_gateway_stats(channel, auth_token, config, tenant, sink.series, now, planner))
+
+  sink.close()
+  print(planner.summary())
+
+  if cache:
+    cache.close()
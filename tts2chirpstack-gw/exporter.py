@@ -10,7 +10,8 @@ import flatdict
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from common.config import Config
-from common.utils import get_pass, get_input, convert_to_seconds, shell
+from common.utils import get_pass, get_input, convert_to_seconds, shell, shell_json
+from common.tts import get_client
 
 # -----------------------------------------------------------------------------
 # Globals
@@ -80,34 +81,45 @@ if __name__ == "__main__":
     # Some variables and checks
     filename_datetime = now.strftime("%Y%m%d%H%M%SZ")
 
-    # Server
-    host = config.get('thethingsstack.host', False)
-    if host:
-        logging.debug(f"Using server {host}")
-        (code, output) = shell(f"ttn-lw-cli use {host} --overwrite")
-        if not 0 == code:
-            logging.error("ERROR: could not set TTS host")
-            sys.exit(2)
+    # HTTP API client or ttn-lw-cli
+    try:
+        client = get_client(config)
+    except Exception as e:
+        logging.error(f"ERROR: {str(e)}")
+        sys.exit(2)
+
+    if client:
+
+        # Gateways are listed by pages with only the fields in the CSV
+        logging.debug("Using the HTTP API")
+        gateways = client.gateways([ "name", "description", "frequency_plan_id", "status_public", "location_public", "antennas" ])
 
-    # Login
-    logging.debug("Login in to your TTI/TTN account")
-    apikey = config.get("thethingsstack.apikey", False)
-    if apikey:
-        (code, output) = shell(f"ttn-lw-cli login --api-key={apikey}")
     else:
-        (code, output) = shell("ttn-lw-cli login")
-    if not 0 == code:
-        logging.error("Login error")
-        sys.exit(2)
-    logging.debug("Logged in correctly")
 
-    # Get gateways
-    logging.debug("Getting gateways")
-    (code, output) = shell(f"ttn-lw-cli gateways list --all")
-    if not 0 == code:
-        logging.error(f"ERROR: not enough permissions to get the list of gateways")
-        sys.exit(2)
-    gateways=json.loads(output.decode('utf-8'))
+        # Server
+        host = config.get('thethingsstack.host', False)
+        if host:
+            logging.debug(f"Using server {host}")
+            (code, output) = shell(f"ttn-lw-cli use {host} --overwrite")
+            if not 0 == code:
+                logging.error("ERROR: could not set TTS host")
+                sys.exit(2)
+
+        # Login
+        logging.debug("Login in to your TTI/TTN account")
+        apikey = config.get("thethingsstack.apikey", False)
+        if apikey:
+            (code, output) = shell(f"ttn-lw-cli login --api-key={apikey}")
+        else:
+            (code, output) = shell("ttn-lw-cli login")
+        if not 0 == code:
+            logging.error("Login error")
+            sys.exit(2)
+        logging.debug("Logged in correctly")
+
+        # Get gateways, parsed while the output is read
+        logging.debug("Getting gateways")
+        gateways = shell_json(f"ttn-lw-cli gateways list --all", int(config.get('thethingsstack.list_timeout', 600)))
 
     # Open filename
     folder = config.get('export_folder', './')
@@ -119,16 +131,32 @@ if __name__ == "__main__":
 
         # Walk gateways
         processed=0
-        for gateway in gateways:
-
-            gateway_id = gateway['ids']['gateway_id']
-
-            try:
-                f.write(row_to_csv(gateway) + "\n")
-                f.flush()
-                processed += 1
-            except Exception as e:
-                logging.error(f"ERROR: parsing gateway {gateway_id}: {str(e)}")    
+        listed=0
+        error=None
+        try:
+            for gateway in gateways:
+
+                listed += 1
+
+                gateway_id = gateway['ids']['gateway_id']
+
+                try:
+                    f.write(row_to_csv(gateway) + "\n")
+                    f.flush()
+                    processed += 1
+                except Exception as e:
+                    logging.error(f"ERROR: parsing gateway {gateway_id}: {str(e)}")    
+        except Exception as e:
+            error=str(e)
+
+    # Listing failed, a partial list is not kept as an export
+    if error is not None:
+        os.remove(filename)
+        if 0 == listed:
+            logging.error(f"ERROR: not enough permissions to get the list of gateways ({error})")
+        else:
+            logging.error(f"ERROR: getting the list of gateways after {listed} gateways ({error}), nothing saved")
+        sys.exit(2)
 
     logging.info(f"{processed} gateways processed and saved into {filename}")
 
@@ -13,6 +13,10 @@ from datetime import datetime, timedelta
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from common.config import Config
 from common.utils import get_pass, get_input, convert_to_seconds, shell
+from common.pool import ordered_map
+from common.paginate import paginate
+from common.euiset import EuiSet
+from common.journal import Journal, row_hash
 
 # -----------------------------------------------------------------------------
 # Globals
@@ -25,27 +29,34 @@ APP_VERSION = "v1.0.0"
 # Methods
 # -----------------------------------------------------------------------------
 
-# Globals
-updated = 0
-created = 0
+def get_existing(client, auth_token, tenant_id, page_size=1000, prefetch=False):
+
+  # Index of the gateways already in the tenant
+  req = api.ListGatewaysRequest()
+  req.tenant_id = tenant_id
+  return EuiSet(gateway.gateway_id for gateway in paginate(client.List, req, auth_token, page_size, prefetch))
 
-def create_or_update(client, auth_token, gateway, tenant_id, tags):
+def gateway_changed(current, desired):
 
-  global updated, created
+  # Compare the fields set by the import, locations up to ~1cm
+  for field in [ 'name', 'description', 'tenant_id', 'stats_interval' ]:
+    if getattr(current, field) != getattr(desired, field):
+      return True
+  for field in [ 'latitude', 'longitude', 'altitude' ]:
+    if round(getattr(current.location, field), 7) != round(getattr(desired.location, field), 7):
+      return True
+  return dict(current.tags) != dict(desired.tags)
 
-  exists = True
+def create_or_update(client, auth_token, gateway, tenant_id, tags, existing, dry_run=False):
+
+  # Returns the outcome (created, updated, unchanged or failed) and the error, if any.
+  # With dry_run nothing is changed, the outcome is what would be done.
   gateway_eui = gateway.get('eui')
   if gateway_eui == None:
-    logging.error(f"Missing EUI")
-    return
+    return ("failed", "missing EUI")
 
   # Check if gateway already exists
-  req = api.GetGatewayRequest()
-  req.gateway_id = gateway_eui
-  try:
-    resp = client.Get(req, metadata=auth_token)
-  except:
-    exists = False
+  exists = gateway_eui in existing
 
   if not exists:
     req = api.CreateGatewayRequest()
@@ -66,23 +77,32 @@ def create_or_update(client, auth_token, gateway, tenant_id, tags):
   #req.gateway.metadata = Struct()
   req.gateway.stats_interval = 30
 
+  # Existing gateways are only updated if something changed
+  if exists:
+    get_req = api.GetGatewayRequest()
+    get_req.gateway_id = gateway_eui
+    try:
+      current = client.Get(get_req, metadata=auth_token).gateway
+      if not gateway_changed(current, req.gateway):
+        return ("unchanged", None)
+    except:
+      pass
+
+  if dry_run:
+    return ("updated" if exists else "created", None)
+
   if not exists:
     try:
       resp = client.Create(req, metadata=auth_token)
-    except Exception(e):
-      logging.error(f"{gateway_eui}: error creating gateway (usually not enough permissions)")
-      return
+    except:
+      return ("failed", "error creating gateway (usually not enough permissions)")
   else:
     try:
       resp = client.Update(req, metadata=auth_token)
     except:
-      logging.error(f"{gateway_eui}: error updating gateway (usually not enough permissions)")
-      return
+      return ("failed", "error updating gateway (usually not enough permissions)")
 
-  if exists:
-    updated += 1
-  else:
-    created += 1
+  return ("updated" if exists else "created", None)
 
 
 # -----------------------------------------------------------------------------
@@ -102,6 +122,8 @@ if __name__ == "__main__":
     parser.add_argument("--api-token", dest="CHIRPSTACK_API_TOKEN", help = "API token with permissions on the tenant gateways")
     parser.add_argument("--tenant-id", dest="CHIRPSTACK_TENANT_ID", help = "Tenant EUI to assign gateways to")
     parser.add_argument("--filename", dest="FILENAME", help = "File with the data to import")
+    parser.add_argument("--resume", action='store_true', help = "Skip rows already imported with the same content (from the journal)")
+    parser.add_argument("--dry-run", action='store_true', help = "Show what would be created or updated without changing anything")
     parser.add_argument("-y", action='store_true', help = "Skip interactive promt")
     args = parser.parse_args()
 
@@ -148,21 +170,65 @@ if __name__ == "__main__":
     # Gateway-queue API client.
     client = api.GatewayServiceStub(channel)
 
-    # Go thourhg the file rows
+    # Gateways already in the tenant, instead of asking for each row
+    try:
+      page_size = int(config.get('chirpstack.page_size', 1000))
+      prefetch = bool(config.get('chirpstack.prefetch', False))
+      existing = get_existing(client, auth_token, tenant_id, page_size, prefetch)
+    except Exception as e:
+      logging.error(f"ERROR: getting the list of gateways in the tenant ({str(e)})")
+      sys.exit(2)
+    logging.info(f"{len(existing)} gateways already in the tenant")
+
+    # Go thourhg the file rows, `workers` gateways at a time
+    workers = int(config.get('chirpstack.workers', 8))
+    counters = { "created": 0, "updated": 0, "unchanged": 0, "failed": 0, "skipped": 0 }
+
+    # Outcome of each row (key, row hash and outcome) in a journal next to the file,
+    # apart from the .journal the export keeps for the same file (read only with --dry-run)
+    journal = None
+    if not args.dry_run or os.path.exists(filename + ".import.journal"):
+      journal = Journal(filename + ".import.journal", int(config.get('journal_batch', 100)))
+
     with open(filename, 'r') as file:
       csvreader = csv.reader(file)
-      line = 0
-      for row in csvreader:
-        line += 1
-        if 1 == line:
-          header = row
-        else:
-          logging.debug(f'Processing line {line-1}')
-          gateway = dict(zip(header, row))
-          create_or_update(client, auth_token, gateway, tenant_id, tags)
+      header = next(csvreader, None) or []
 
-    logging.info(f"{created} gateways created")
-    logging.info(f"{updated} gateways updated")
+      # Rows to import, with --resume rows applied before with the same content are skipped
+      def rows():
+        for row in csvreader:
+          gateway = dict(zip(header, row))
+          gateway["_hash"] = row_hash(row)
+          if args.resume and journal:
+            entry = journal.get(str(gateway.get('eui')).lower())
+            if entry and entry[0] == gateway["_hash"] and entry[1] in [ "created", "updated", "unchanged" ]:
+              counters["skipped"] += 1
+              continue
+          yield gateway
+
+      gateways = rows()
+      import_gateway = lambda gateway: (gateway, create_or_update(client, auth_token, gateway, tenant_id, tags, existing, args.dry_run))
+      for (line, (gateway, (outcome, error))) in enumerate(ordered_map(import_gateway, gateways, workers), start=1):
+        logging.debug(f"Processing line {line}: {gateway.get('eui')} {outcome}")
+        counters[outcome] += 1
+        if journal and not args.dry_run:
+          journal.add(str(gateway.get('eui')).lower(), gateway["_hash"], outcome)
+        if error:
+          logging.error(f"{gateway.get('eui')}: {error}")
+
+    if journal:
+      journal.close()
+    if counters['skipped']:
+      logging.info(f"{counters['skipped']} gateways skipped, already imported")
+
+    if args.dry_run:
+      logging.info(f"Dry run: {counters['created']} gateways to create, {counters['updated']} to update, {counters['unchanged']} unchanged")
+    else:
+      logging.info(f"{counters['created']} gateways created")
+      logging.info(f"{counters['updated']} gateways updated")
+      logging.info(f"{counters['unchanged']} gateways unchanged")
+    if counters['failed']:
+      logging.info(f"{counters['failed']} gateways failed")
 
     total_time=round(time.time() - start, 2)
     logging.info(f"Total time {total_time}s")
@@ -6,13 +6,17 @@ import grpc
 import json
 import logging
 import argparse
+import threading
 
 from chirpstack_api import api
 from datetime import datetime, timedelta
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from common.config import Config
-from common.utils import get_pass, get_input, convert_to_seconds, shell
+from common.utils import get_pass, get_input, convert_to_seconds, shell, write_atomic
+from common.pool import ordered_map
+from concurrent.futures import ThreadPoolExecutor
+from common.paginate import paginate
 
 # -----------------------------------------------------------------------------
 # Globals
@@ -25,67 +29,83 @@ APP_VERSION = "v1.0.0"
 # Methods
 # -----------------------------------------------------------------------------
 
-def get_devices(channel, auth_token, application_id):
+def get_applications(channel, auth_token, tenant_id, page_size=1000, prefetch=False):
+
+  client = api.ApplicationServiceStub(channel)
+  req = api.ListApplicationsRequest()
+  req.tenant_id = tenant_id
+  yield from paginate(client.List, req, auth_token, page_size, prefetch)
+
+def get_devices(channel, auth_token, application_id, page_size=1000, prefetch=False):
 
   client = api.DeviceServiceStub(channel)
   req = api.ListDevicesRequest()
-  req.limit = 10000
-  req.offset = 0
   req.application_id = application_id
-  try:
-    resp = client.List(req, metadata=auth_token)
-  except Exception as err:
-    print(f"Error getting the list of devices for application {application_id} ({str(err)})")
-    return {}
+  yield from paginate(client.List, req, auth_token, page_size, prefetch)
 
-  return resp.result
+def call(method, req, auth_token, limit=None):
 
-def get_device_keys(channel, auth_token, dev_eui):
+  # Asynchronous call, with `limit` (a semaphore shared by all the exports)
+  # held until the response arrives
+  if limit is None:
+    return method.future(req, metadata=auth_token)
+  limit.acquire()
+  try:
+    future = method.future(req, metadata=auth_token)
+  except:
+    limit.release()
+    raise
+  future.add_done_callback(lambda _: limit.release())
+  return future
+
+def get_device_keys(client, auth_token, dev_eui, limit=None):
 
-  client = api.DeviceServiceStub(channel)
   req = api.GetDeviceKeysRequest()
   req.dev_eui = dev_eui
-  try:
-    resp = client.GetKeys(req, metadata=auth_token)
-  except Exception as err:
-    print(f"Error getting the root keys for device {dev_eui} ({str(err)})")
-    return {}
+  return call(client.GetKeys, req, auth_token, limit)
 
-  return resp.device_keys
+def get_device_activation(client, auth_token, dev_eui, limit=None):
 
-def get_device_activation(channel, auth_token, dev_eui):
-
-  client = api.DeviceServiceStub(channel)
   req = api.GetDeviceActivationRequest()
   req.dev_eui = dev_eui
-  try:
-    resp = client.GetActivation(req, metadata=auth_token)
-  except Exception as err:
-    print(f"Error getting the activation keys for device {dev_eui} ({str(err)})")
-    return {}
-
-  return resp.device_activation
+  return call(client.GetActivation, req, auth_token, limit)
 
-def get_device_link_metrics(channel, auth_token, dev_eui, days=7):
+def get_device_link_metrics(client, auth_token, dev_eui, days=7, limit=None):
 
   now = datetime.utcnow()
-  start_dt = (now - timedelta(days=days)).strftime('%Y-%m-%dT%H:%M:%SZ')
-  end_dt = now.strftime('%Y-%m-%dT%H:%M:%SZ')
-
-  client = api.DeviceServiceStub(channel)
   req = api.GetDeviceLinkMetricsRequest()
   req.dev_eui = dev_eui
   req.start.FromDatetime(now - timedelta(days=days))
   req.end.FromDatetime(now)
   req.aggregation = 1 # days
-
+  return call(client.GetLinkMetrics, req, auth_token, limit)
+
+def get_device_data(client, auth_token, device, days=7, limit=None):
+
+  # The three calls for a device are sent at the same time, errors are
+  # reported and leave an empty result (so the row fails)
+  dev_eui = device.dev_eui
+  calls = [
+    ("root keys", get_device_keys(client, auth_token, dev_eui, limit)),
+    ("activation keys", get_device_activation(client, auth_token, dev_eui, limit)),
+    ("link metrics", get_device_link_metrics(client, auth_token, dev_eui, days, limit)),
+  ]
+  results = []
+  for (name, future) in calls:
+    try:
+      results.append(future.result())
+    except Exception as err:
+      print(f"Error getting the {name} for device {dev_eui} ({str(err)})")
+      results.append(None)
+
+  (keys, activation, metrics) = results
+  keys = keys.device_keys if keys is not None else {}
+  activation = activation.device_activation if activation is not None else {}
+  metrics = metrics if metrics is not None else {}
   try:
-    resp = client.GetLinkMetrics(req, metadata=auth_token)
-  except Exception as err:
-    print(f"Error getting the activation keys for device {dev_eui} ({str(err)})")
-    return {}
-
-  return resp
+    return (row_to_csv(device, keys, activation, metrics, days), None)
+  except Exception as e:
+    return (None, f"ERROR: processing device {dev_eui}: {str(e)}")
 
 # -----------------------------------------------------------------------------
 
@@ -114,6 +134,44 @@ def row_to_csv(device, keys, activation, metrics, days = 7):
 
     return ','.join(fields)
 
+def export_application(channel, client, auth_token, application_id, filename, page_size=1000, prefetch=False, workers=8, sync_rows=1000, limit=None):
+
+  # Export the devices of an application to `filename`, returns the number of
+  # rows written and failed, the time it took and the error listing the
+  # devices, if any (the export is then incomplete)
+  start = time.time()
+  devices = get_devices(channel, auth_token, application_id, page_size, prefetch)
+  processed = 0
+  failed = 0
+  error = None
+  with open(filename, "w", buffering=1024*1024) as f:
+
+    # Header
+    f.write("device_id description dev_eui join_eui app_key dev_addr app_s_key nwk_s_enc_key s_nwk_s_int_key f_nwk_s_int_key f_cnt_up n_f_cnt_down a_f_cnt_down last_seen_at 7 6 5 4 3 2 1\n".replace(' ',','))
+
+    # Walk devices, `workers` at a time, rows are written in the same order as the list
+    export_device = lambda device: get_device_data(client, auth_token, device, 7, limit)
+    try:
+      for (row, device_error) in ordered_map(export_device, devices, workers):
+        if device_error:
+          logging.error(device_error)
+          failed += 1
+          continue
+        f.write(row + "\n")
+        processed += 1
+        if 0 == processed % sync_rows:
+          f.flush()
+          os.fsync(f.fileno())
+    except grpc.RpcError as err:
+      error = f"{err.code().name}: {err.details()}"
+    except Exception as err:
+      error = str(err)
+
+    f.flush()
+    os.fsync(f.fileno())
+
+  return (processed, failed, round(time.time() - start, 2), error)
+
 
 # -----------------------------------------------------------------------------
 # Entry point
@@ -130,7 +188,8 @@ if __name__ == "__main__":
     parser.add_argument("--config", "-c", default="config.yml", help = "Configuration file")
     parser.add_argument("--server", dest="CHIRPSTACK_SERVER", help = "Chirpstack server (ip/domain and port)")
     parser.add_argument("--api-token", dest="CHIRPSTACK_API_TOKEN", help = "API token with permissions on the application")
-    parser.add_argument("--application-id", dest="CHIRPSTACK_APPLICATION_ID", help = "Application EUI to monitor the devices")
+    parser.add_argument("--application-id", dest="CHIRPSTACK_APPLICATION_ID", help = "Application EUI to monitor the devices (or several, comma separated)")
+    parser.add_argument("--tenant-id", dest="CHIRPSTACK_TENANT_ID", help = "Tenant ID to export all its applications")
     parser.add_argument("-y", action='store_true', help = "Skip interactive promt")
     args = parser.parse_args()
 
@@ -149,55 +208,86 @@ if __name__ == "__main__":
       print()
       config.set('chirpstack.server', get_input("Chirpstack server (ip/domain and port)", config.get('chirpstack.server')))
       config.set('chirpstack.api_token', get_pass("API token with permissions on the application", config.get('chirpstack.api_token')))
-      config.set('chirpstack.application_id', get_input("Application EUI to monitor the devices", config.get('chirpstack.application_id')))
+      config.set('chirpstack.tenant_id', get_input("Tenant ID to export all its applications (empty for a single application)", config.get('chirpstack.tenant_id')))
+      if not config.get('chirpstack.tenant_id'):
+        config.set('chirpstack.application_id', get_input("Application EUI to monitor the devices", config.get('chirpstack.application_id')))
       print()
 
     # Some variables and checks
     filename_datetime = now.strftime("%Y%m%d%H%M%SZ")
+    tenant_id = config.get('chirpstack.tenant_id')
     application_id = config.get('chirpstack.application_id')
-    if not application_id:
-        logging.error("ERROR: Missing application_id to import to")
+    if not tenant_id and not application_id:
+        logging.error("ERROR: Missing application_id or tenant_id to export")
         sys.exit()
     server = config.get('chirpstack.server', 'localhost:8080')
 
-    # Hello
-    logging.info(f"Exporting all devices from ChirpStack application '{application_id}'")
-
     # Define the API key meta-data.
     auth_token = [("authorization", "Bearer %s" % config.get('chirpstack.api_token'))]
 
     # Connect without using TLS.
     channel = grpc.insecure_channel(server)
 
-    # Get devices
-    devices = get_devices(channel, auth_token, application_id)
-    num_devices = len(devices)
-
-    # Open filename
+    # Device API client, shared by all the calls
+    client = api.DeviceServiceStub(channel)
+
+    # Options
+    page_size = int(config.get('chirpstack.page_size', 1000))
+    prefetch = bool(config.get('chirpstack.prefetch', False))
+    workers = int(config.get('chirpstack.workers', 8))
+    sync_rows = int(config.get('chirpstack.sync_rows', 1000))
+
+    # Applications to export, all the ones in the tenant or the given ones
+    if tenant_id:
+        logging.info(f"Exporting all devices from ChirpStack tenant '{tenant_id}'")
+        try:
+            applications = [ (application.id, application.name) for application in get_applications(channel, auth_token, tenant_id, page_size, prefetch) ]
+        except Exception as e:
+            logging.error(f"ERROR: getting the list of applications for tenant {tenant_id} ({str(e)})")
+            sys.exit(2)
+        logging.info(f"{len(applications)} applications in the tenant")
+    else:
+        applications = [ (id.strip(), "") for id in str(application_id).split(',') if id.strip() ]
+        logging.info(f"Exporting all devices from ChirpStack application '{application_id}'")
+
+    # Applications are exported `applications` at a time over the same channel,
+    # with at most `max_rpcs` device calls in flight between all of them
+    concurrency = int(config.get('chirpstack.applications', 4))
+    limit = threading.BoundedSemaphore(int(config.get('chirpstack.max_rpcs', 64)))
+
+    # Export one application
     folder = config.get('export_folder', './')
-    filename = f"{folder}cs_devices_{application_id}_{filename_datetime}_all.csv"
-    with open(filename, "w") as f:
-
-        # Header
-        f.write("device_id description dev_eui join_eui app_key dev_addr app_s_key nwk_s_enc_key s_nwk_s_int_key f_nwk_s_int_key f_cnt_up n_f_cnt_down a_f_cnt_down last_seen_at 7 6 5 4 3 2 1\n".replace(' ',','))
-
-        # Walk devices
-        processed=0
-        for device in devices:
-
-            try:
-                keys = get_device_keys(channel, auth_token, device.dev_eui)
-                activation = get_device_activation(channel, auth_token, device.dev_eui)
-                metrics = get_device_link_metrics(channel, auth_token, device.dev_eui, 7)
-                f.write(row_to_csv(device, keys, activation, metrics, 7) + "\n")
-                f.flush()
-                processed += 1
-            except Exception as e:
-                logging.error(f"ERROR: processing device {device.dev_eui}: {str(e)}")    
+    def export(application):
+        (id, name) = application
+        filename = f"{folder}cs_devices_{id}_{filename_datetime}_all.csv"
+        (processed, failed, elapsed, error) = export_application(channel, client, auth_token, id, filename, page_size, prefetch, workers, sync_rows, limit)
+        if error:
+            logging.error(f"ERROR: getting the list of devices for application {id}, export incomplete with {processed} devices in {filename} ({error})")
+        else:
+            logging.info(f"{processed} devices processed and saved into {filename} ({elapsed}s)")
+        return { "application_id": id, "application_name": name, "filename": filename, "rows": processed, "failed": failed, "time": elapsed, "error": error }
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        exported = list(executor.map(export, applications))
 
     # Summary
-    logging.info(f"{processed} devices processed and saved into {filename}")
+    processed = sum([ application["rows"] for application in exported ])
     total_time=round(time.time() - start, 2)
+    if len(exported) > 1 or tenant_id:
+        manifest = f"{folder}cs_devices_{tenant_id or 'applications'}_{filename_datetime}_manifest.json"
+        write_atomic(manifest, json.dumps({
+            "tenant_id": tenant_id or "",
+            "started_at": now.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "time": total_time,
+            "rows": processed,
+            "applications": exported,
+        }, indent=2))
+        logging.info(f"{processed} devices from {len(exported)} applications processed, manifest saved into {manifest}")
     logging.info(f"Total time {total_time}s")
 
+    # Some application could not be listed
+    incomplete = [ application["application_id"] for application in exported if application["error"] ]
+    if incomplete:
+        logging.error(f"ERROR: {len(incomplete)} applications could not be exported completely: {', '.join(incomplete)}")
+        sys.exit(2)
 
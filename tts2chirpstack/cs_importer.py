@@ -13,6 +13,10 @@ from datetime import datetime, timedelta
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from common.config import Config
 from common.utils import get_pass, get_input, convert_to_seconds, shell
+from common.pool import ordered_map
+from common.paginate import paginate
+from common.euiset import EuiSet
+from common.journal import Journal, row_hash
 
 # -----------------------------------------------------------------------------
 # Globals
@@ -25,24 +29,50 @@ APP_VERSION = "v1.0.0"
 # Methods
 # -----------------------------------------------------------------------------
 
-# Globals
-updated = 0
-created = 0
+def get_existing(client, auth_token, application_id, page_size=1000, prefetch=False):
+
+  # Index of the devices already in the application
+  req = api.ListDevicesRequest()
+  req.application_id = application_id
+  return EuiSet(device.dev_eui for device in paginate(client.List, req, auth_token, page_size, prefetch))
+
+def activation_changed(client, auth_token, device):
 
-def create_or_update(client, auth_token, device, application_id, device_profile_id):
+  # Compare the activation in ChirpStack with the one in the row (keys are
+  # compared case-insensitive), any error counts as changed. Frame counters
+  # in ChirpStack that went past the ones in the row are not a change (the
+  # device kept sending), activating it again would roll them back.
+  req = api.GetDeviceActivationRequest()
+  req.dev_eui = device.get('dev_eui')
+  try:
+    current = client.GetActivation(req, metadata=auth_token).device_activation
+  except:
+    return True
+  for field in [ 'dev_addr', 'app_s_key', 'nwk_s_enc_key', 's_nwk_s_int_key', 'f_nwk_s_int_key' ]:
+    if getattr(current, field).lower() != device.get(field, '').lower():
+      return True
+  for field in [ 'f_cnt_up', 'n_f_cnt_down', 'a_f_cnt_down' ]:
+    if getattr(current, field) < int('0'+device.get(field, '')):
+      return True
+  return False
 
-  global updated, created
+def create_or_update(client, auth_token, device, application_id, device_profile_id, existing, dry_run=False):
 
-  exists = True
+  # Returns the outcome (created, updated, unchanged or failed) and the error, if any.
+  # Calls for the same device are made in order, devices run concurrently.
+  # With dry_run nothing is changed, the outcome is what would be done.
   dev_eui = device.get('dev_eui')
 
   # Check if device already exists
-  req = api.GetDeviceRequest()
-  req.dev_eui = dev_eui
-  try:
-    resp = client.Get(req, metadata=auth_token)
-  except:
-    exists = False
+  exists = dev_eui in existing
+
+  # Existing devices are only activated again if the activation changed
+  if exists:
+    if '' == device.get('dev_addr', '') or not activation_changed(client, auth_token, device):
+      return ("unchanged", None)
+
+  if dry_run:
+    return ("updated" if exists else "created", None)
 
   if not exists:
 
@@ -59,8 +89,7 @@ def create_or_update(client, auth_token, device, application_id, device_profile_
     try:
       resp = client.Create(req, metadata=auth_token)
     except:
-      logging.error(f"{dev_eui}: error creating device")
-      return
+      return ("failed", "error creating device")
 
     # Create keys (not needed?)
     req = api.CreateDeviceKeysRequest()
@@ -70,8 +99,7 @@ def create_or_update(client, auth_token, device, application_id, device_profile_
     try:
       resp = client.CreateKeys(req, metadata=auth_token)
     except:
-      logging.error(f"{dev_eui}: error creating keys")
-      return
+      return ("failed", "error creating keys")
     
   # Activate keys
   if not '' == device.get('dev_addr'):
@@ -88,13 +116,9 @@ def create_or_update(client, auth_token, device, application_id, device_profile_
     try:
       resp = client.Activate(req, metadata=auth_token)
     except:
-      logging.error(f"{dev_eui}: error activating device")
-      return
+      return ("failed", "error activating device")
 
-  if exists:
-    updated += 1
-  else:
-    created += 1
+  return ("updated" if exists else "created", None)
 
 
 # -----------------------------------------------------------------------------
@@ -115,6 +139,8 @@ if __name__ == "__main__":
     parser.add_argument("--application-id", dest="CHIRPSTACK_APPLICATION_ID", help = "Application EUI to save the devices to")
     parser.add_argument("--device-profile-id", dest="CHIRPSTACK_DEVICE_PROFILE_ID", help = "Device profile EUI to use when creating the devices")
     parser.add_argument("--filename", dest="FILENAME", help = "File with the data to import")
+    parser.add_argument("--resume", action='store_true', help = "Skip rows already imported with the same content (from the journal)")
+    parser.add_argument("--dry-run", action='store_true', help = "Show what would be created or updated without changing anything")
     parser.add_argument("-y", action='store_true', help = "Skip interactive promt")
     args = parser.parse_args()
 
@@ -165,21 +191,79 @@ if __name__ == "__main__":
     # Device-queue API client.
     client = api.DeviceServiceStub(channel)
 
-    # Go thourhg the file rows
+    # Devices already in the application, instead of asking for each row
+    try:
+      page_size = int(config.get('chirpstack.page_size', 1000))
+      prefetch = bool(config.get('chirpstack.prefetch', False))
+      existing = get_existing(client, auth_token, application_id, page_size, prefetch)
+    except Exception as e:
+      logging.error(f"ERROR: getting the list of devices in the application ({str(e)})")
+      sys.exit(2)
+    logging.info(f"{len(existing)} devices already in the application")
+
+    # Rows that could not be imported are saved to a rejects file with the error
+    rejects_filename = config.get('rejects', os.path.splitext(filename)[0] + "_rejects.csv")
+    rejects = None
+
+    # Go thourhg the file rows, `workers` devices at a time. Outcomes are
+    # counted here, in the same order as the file.
+    workers = int(config.get('chirpstack.workers', 8))
+    counters = { "created": 0, "updated": 0, "unchanged": 0, "failed": 0, "skipped": 0 }
+
+    # Outcome of each row (key, row hash and outcome) in a journal next to the file,
+    # apart from the .journal the export keeps for the same file (read only with --dry-run)
+    journal = None
+    if not args.dry_run or os.path.exists(filename + ".import.journal"):
+      journal = Journal(filename + ".import.journal", int(config.get('journal_batch', 100)))
+
     with open(filename, 'r') as file:
       csvreader = csv.reader(file)
-      line = 0
-      for row in csvreader:
-        line += 1
-        if 1 == line:
-          header = row
-        else:
-          logging.debug(f'Processing line {line-1}')
+      header = next(csvreader, None) or []
+
+      # Rows to import, with --resume rows applied before with the same content are skipped
+      def rows():
+        for row in csvreader:
           device = dict(zip(header, row))
-          create_or_update(client, auth_token, device, application_id, device_profile_id)
+          device["_hash"] = row_hash(row)
+          if args.resume and journal:
+            entry = journal.get(str(device.get('dev_eui')).lower())
+            if entry and entry[0] == device["_hash"] and entry[1] in [ "created", "updated", "unchanged" ]:
+              counters["skipped"] += 1
+              continue
+          yield device
+
+      devices = rows()
+      import_device = lambda device: (device, create_or_update(client, auth_token, device, application_id, device_profile_id, existing, args.dry_run))
+      for (line, (device, (outcome, error))) in enumerate(ordered_map(import_device, devices, workers), start=1):
+        logging.debug(f"Processing line {line}: {device.get('dev_eui')} {outcome}")
+        counters[outcome] += 1
+        if journal and not args.dry_run:
+          journal.add(str(device.get('dev_eui')).lower(), device["_hash"], outcome)
+        if error:
+          logging.error(f"{device.get('dev_eui')}: {error}")
+          if rejects is None:
+            rejects = open(rejects_filename, "w", newline='')
+            rejects_writer = csv.writer(rejects)
+            rejects_writer.writerow(header + ["error"])
+          rejects_writer.writerow([ device.get(column, '') for column in header ] + [error])
+          rejects.flush()
+
+    if rejects:
+      rejects.close()
+
+    if journal:
+      journal.close()
+    if counters['skipped']:
+      logging.info(f"{counters['skipped']} devices skipped, already imported")
 
-    logging.info(f"{created} devices created")
-    logging.info(f"{updated} devices updated")
+    if args.dry_run:
+      logging.info(f"Dry run: {counters['created']} devices to create, {counters['updated']} to update, {counters['unchanged']} unchanged")
+    else:
+      logging.info(f"{counters['created']} devices created")
+      logging.info(f"{counters['updated']} devices updated")
+      logging.info(f"{counters['unchanged']} devices unchanged")
+    if counters['failed']:
+      logging.info(f"{counters['failed']} devices failed, saved to {rejects_filename}")
 
     total_time=round(time.time() - start, 2)
     logging.info(f"Total time {total_time}s")
@@ -5,7 +5,9 @@ import time
 import grpc
 import json
 import logging
+import string
 import argparse
+import numpy
 
 from chirpstack_api import api
 from datetime import datetime, timedelta
@@ -13,6 +15,8 @@ from datetime import datetime, timedelta
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from common.config import Config
 from common.utils import get_pass, get_input, convert_to_seconds, shell
+from common.pool import ordered_map
+from common.paginate import paginate
 
 # -----------------------------------------------------------------------------
 # Globals
@@ -25,53 +29,52 @@ APP_VERSION = "v1.0.0"
 # Methods
 # -----------------------------------------------------------------------------
 
-def get_devices(channel, auth_token, application_id):
+def get_devices(channel, auth_token, application_id, page_size=1000, prefetch=False):
 
   client = api.DeviceServiceStub(channel)
   req = api.ListDevicesRequest()
-  req.limit = 10000
-  req.offset = 0
   req.application_id = application_id
   try:
-    resp = client.List(req, metadata=auth_token)
+    yield from paginate(client.List, req, auth_token, page_size, prefetch)
   except Exception as err:
     print(f"Error getting the list of devices for application {application_id} ({str(err)})")
-    return {}
 
-  return resp.result
+def get_device_dev_addr(client, auth_token, dev_eui):
 
-def get_device_activation(channel, auth_token, dev_eui):
-
-  client = api.DeviceServiceStub(channel)
   req = api.GetDeviceActivationRequest()
   req.dev_eui = dev_eui
   try:
     resp = client.GetActivation(req, metadata=auth_token)
   except Exception as err:
     print(f"Error getting the activation keys for device {dev_eui} ({str(err)})")
-    return {}
+    return ''
 
-  return resp.device_activation
+  return resp.device_activation.dev_addr
 
 # -----------------------------------------------------------------------------
 
-def get_net_id(dev_addr):
-    
-    if dev_addr == '':
-      return 'Invalid'
-    dev_addr_dec = int(dev_addr, 16)
-    dev_addr_bin = f'{dev_addr_dec:0>32b}'
-    type_id = dev_addr_bin.find('0')
-    if type_id > 7:
-      return 'Invalid'
-    nwkid_bits = [6,6,9,11,12,13,15,17][type_id]
-    nwkid_bin = dev_addr_bin[type_id+1:type_id+nwkid_bits+1]
-    nwkid = int(nwkid_bin, 2)
-    netid = (type_id << 21) + nwkid
+# Number of NwkID bits for each NetID type
+NWKID_BITS = [6,6,9,11,12,13,15,17]
+
+def get_net_ids(dev_addrs):
 
-    return f"{netid:0>6X}"
+  # Classify all the DevAddrs at once, returns the NetID type, NwkID and NetID
+  # of each one (-1 for the invalid ones)
+  valid = numpy.array([ 8 == len(dev_addr) and '' == dev_addr.strip(string.hexdigits) for dev_addr in dev_addrs ], dtype=bool)
+  addrs = numpy.zeros(len(dev_addrs), dtype=numpy.uint32)
+  hexes = ''.join([ dev_addr for (dev_addr, ok) in zip(dev_addrs, valid) if ok ])
+  addrs[valid] = numpy.frombuffer(bytes.fromhex(hexes), dtype='>u4')
 
+  # The type is the number of leading 1 bits, the prefix for type N is N ones and a zero
+  types = numpy.full(len(addrs), -1, dtype=numpy.int32)
+  nwkids = numpy.zeros(len(addrs), dtype=numpy.uint32)
+  for (type_id, bits) in enumerate(NWKID_BITS):
+    match = valid & ((addrs >> (31 - type_id)) == ((1 << (type_id + 1)) - 2))
+    types[match] = type_id
+    nwkids[match] = (addrs[match] >> (31 - type_id - bits)) & ((1 << bits) - 1)
 
+  net_ids = numpy.where(types >= 0, (types.astype(numpy.int64) << 21) + nwkids, -1)
+  return (addrs, types, nwkids, net_ids)
 
 # -----------------------------------------------------------------------------
 # Entry point
@@ -126,26 +129,47 @@ if __name__ == "__main__":
     # Connect without using TLS.
     channel = grpc.insecure_channel(server)
 
-    # Get devices
-    devices = get_devices(channel, auth_token, application_id)
-    num_devices = len(devices)
+    # Device API client, shared by all the calls
+    client = api.DeviceServiceStub(channel)
 
-    # Dict to hold the number of devices per NetID
-    net_ids = {}
+    # Get devices
+    page_size = int(config.get('chirpstack.page_size', 1000))
+    prefetch = bool(config.get('chirpstack.prefetch', False))
+    devices = get_devices(channel, auth_token, application_id, page_size, prefetch)
+
+    # Get the current DevAddr of each device, `workers` devices at a time
+    workers = int(config.get('chirpstack.workers', 8))
+    get_dev_addr = lambda device: get_device_dev_addr(client, auth_token, device.dev_eui)
+    dev_addrs = list(ordered_map(get_dev_addr, devices, workers))
+    num_devices = len(dev_addrs)
+    if 0 == num_devices:
+        print("\nStatistics:\n0 in total")
+        sys.exit()
 
-    # Walk the devices to get their current DevAddr and NetID
-    for device in devices:
-        keys = get_device_activation(channel, auth_token, device.dev_eui)
-        net_id = get_net_id(keys.dev_addr)
-        if net_id in net_ids:
-          net_ids[net_id] = net_ids[net_id] + 1
-        else:
-          net_ids[net_id] = 1
+    # Classify them all by NetID
+    (addrs, types, nwkids, net_ids) = get_net_ids(dev_addrs)
 
     # Output totals
     print(f"\nStatistics:\n{num_devices} in total\nNet ID:")
-    for net_id in net_ids:
-        percent = round(100 * net_ids[net_id] / num_devices, 2)
-        print(f" * {net_id}: {net_ids[net_id]} devices ({percent}%)")
-
+    (values, counts) = numpy.unique(net_ids, return_counts=True)
+    for (net_id, count) in sorted(zip(values.tolist(), counts.tolist()), key=lambda item: -item[1]):
+        percent = round(100 * count / num_devices, 2)
+        name = "Invalid" if net_id < 0 else f"{net_id:0>6X}"
+        print(f" * {name}: {count} devices ({percent}%)")
+
+    # DevAddr histogram by NetID type and NwkID, with the range of addresses in use
+    print("DevAddr:")
+    for net_id in values.tolist():
+        if net_id < 0:
+            continue
+        match = net_ids == net_id
+        count = int(match.sum())
+        type_id = int(types[match][0])
+        nwkid = int(nwkids[match][0])
+        percent = round(100 * count / num_devices, 2)
+        bar = '#' * max(1, int(round(40 * count / num_devices)))
+        print(f" * type {type_id} NwkID {nwkid:0>2X} ({int(addrs[match].min()):0>8X}-{int(addrs[match].max()):0>8X}): {count} devices ({percent}%) {bar}")
+
+    total_time=round(time.time() - start, 2)
+    logging.info(f"Total time {total_time}s")
 
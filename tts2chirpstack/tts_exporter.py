@@ -10,7 +10,10 @@ import flatdict
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from common.config import Config
-from common.utils import get_pass, get_input, convert_to_seconds, shell
+from common.utils import get_pass, get_input, convert_to_seconds, shell, shell_json
+from common.pool import ordered_map
+from common.tts import get_client
+from common.journal import Journal
 
 # -----------------------------------------------------------------------------
 # Globals
@@ -44,6 +47,45 @@ def row_to_csv(row):
     
     return ','.join(fields)
 
+def cli_device(application_id, device, timeout=10):
+
+    # Device info using ttn-lw-cli
+    device_id = device['ids']['device_id']
+    (code, output) = shell(f"ttn-lw-cli end-devices get {application_id} {device_id} --name --description --root-keys --session", timeout)
+    if not 0 == code:
+        raise Exception(f"ttn-lw-cli exit code {code}")
+    return json.loads(output.decode('utf-8'))
+
+def get_device(fetch, device, retries=2):
+
+    # Get the device info from TTS, retrying failed calls up to `retries` times.
+    # Returns the CSV row or None and the last error.
+    device_id = device['ids']['device_id']
+    error = None
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            logging.debug(f"Retrying device {device_id} ({attempt}/{retries})")
+        try:
+            return (row_to_csv(fetch(device)), None)
+        except Exception as e:
+            error = f"ERROR: processing device {device_id}: {str(e)}"
+    return (None, error)
+
+def get_exported(filename):
+
+    # Device IDs already in a previous export, a partial last row (the script
+    # died while writing it) is removed so it gets exported again
+    device_ids = set()
+    with open(filename, "rb+") as f:
+        content = f.read()
+        if content and not content.endswith(b"\n"):
+            f.truncate(content.rfind(b"\n") + 1)
+            content = content[:content.rfind(b"\n") + 1]
+    for line in content.decode('utf-8').splitlines()[1:]:
+        if line:
+            device_ids.add(line.split(',')[0])
+    return device_ids
+
 # -----------------------------------------------------------------------------
 # Entrypoint
 # -----------------------------------------------------------------------------
@@ -60,6 +102,7 @@ if __name__ == "__main__":
     parser.add_argument("--application-id", dest="THETHINGSSTACK_APPLICATION_ID", help = "Application ID")
     parser.add_argument("--apikey", dest="THETHINGSSTACK_APIKEY", help = "API Key to login")
     parser.add_argument("--active-since", dest="THETHINGSSTACK_ACTIVE_SINCE", help = "Active in the last X seconds (also time units or fixed datetime allowed)")
+    parser.add_argument("--resume", help = "Continue a previous export, appending to its CSV file")
     parser.add_argument("-y", action='store_true', help = "Skip interactive promt")
     args = parser.parse_args()
 
@@ -108,70 +151,124 @@ if __name__ == "__main__":
     else:
         logging.info(f"Exporting devices from TTS application '{application_id}' last updated after {last_seen_after}")
 
-    # Server
-    host = config.get('thethingsstack.host', False)
-    if host:
-        logging.debug(f"Using server {host}")
-        (code, output) = shell(f"ttn-lw-cli use {host} --overwrite")
+    # HTTP API client or ttn-lw-cli
+    try:
+        client = get_client(config)
+    except Exception as e:
+        logging.error(f"ERROR: {str(e)}")
+        sys.exit(2)
+    retries = int(config.get('thethingsstack.retries', 2))
+    timeout = int(config.get('thethingsstack.timeout', 10))
+    list_timeout = int(config.get('thethingsstack.list_timeout', 600))
+
+    if client:
+
+        # Devices are listed by pages, keys and session come from the JS, NS and AS
+        logging.debug("Using the HTTP API")
+        devices = client.end_devices(application_id, [ "name", "description", "last_seen_at" ])
+        fetch = lambda device: client.end_device(application_id, device['ids']['device_id'], device)
+
+    else:
+
+        # Server
+        host = config.get('thethingsstack.host', False)
+        if host:
+            logging.debug(f"Using server {host}")
+            (code, output) = shell(f"ttn-lw-cli use {host} --overwrite")
+            if not 0 == code:
+                logging.error("ERROR: could not set TTS host")
+                sys.exit(2)
+
+        # Login
+        logging.debug("Login in to your TTI/TTN account")
+        apikey = config.get("thethingsstack.apikey", False)
+        if apikey:
+            (code, output) = shell(f"ttn-lw-cli login --api-key={apikey}")
+        else:
+            (code, output) = shell("ttn-lw-cli login")
         if not 0 == code:
-            logging.error("ERROR: could not set TTS host")
+            logging.error("Login error")
             sys.exit(2)
+        logging.debug("Logged in correctly")
 
-    # Login
-    logging.debug("Login in to your TTI/TTN account")
-    apikey = config.get("thethingsstack.apikey", False)
-    if apikey:
-        (code, output) = shell(f"ttn-lw-cli login --api-key={apikey}")
-    else:
-        (code, output) = shell("ttn-lw-cli login")
-    if not 0 == code:
-        logging.error("Login error")
-        sys.exit(2)
-    logging.debug("Logged in correctly")
+        # Get devices in application, parsed while the output is read
+        logging.debug("Getting application devices")
+        devices = shell_json(f"ttn-lw-cli end-devices search {application_id} --last-seen-at", list_timeout)
+        fetch = lambda device: cli_device(application_id, device, timeout)
 
-    # Get devices in application
-    logging.debug("Getting application devices")
-    (code, output) = shell(f"ttn-lw-cli end-devices search {application_id} --last-seen-at")
-    if not 0 == code:
-        logging.error(f"ERROR: not enough permissions for application {application_id}")
-        sys.exit(2)
-    devices=json.loads(output.decode('utf-8'))
+    # Open filename, or the one to resume. The journal next to it keeps the
+    # devices already exported, the file is synced before the journal.
+    done = set()
+    if args.resume:
+        filename = args.resume
+        if not os.path.exists(filename):
+            logging.error(f"ERROR: {filename} does not exist")
+            sys.exit(2)
+        done = get_exported(filename)
+    else:
+        folder = config.get('export_folder', './')
+        filename = f"{folder}tts_devices_{application_id}_{filename_datetime}_{delta}.csv"
+    with open(filename, "a" if args.resume else "w") as f:
 
-    # Open filename
-    folder = config.get('export_folder', './')
-    filename = f"{folder}tts_devices_{application_id}_{filename_datetime}_{delta}.csv"
-    with open(filename, "w") as f:
+        journal = Journal(filename + ".journal", 100, f)
+        if args.resume:
+            done |= journal.done
+            logging.info(f"Resuming export into {filename}, {len(done)} devices already exported")
 
         # Header
-        f.write("device_id description dev_eui join_eui app_key dev_addr app_s_key nwk_s_enc_key s_nwk_s_int_key f_nwk_s_int_key f_cnt_up n_f_cnt_down a_f_cnt_down\n".replace(' ',','))
+        if not args.resume:
+            f.write("device_id description dev_eui join_eui app_key dev_addr app_s_key nwk_s_enc_key s_nwk_s_int_key f_nwk_s_int_key f_cnt_up n_f_cnt_down a_f_cnt_down\n".replace(' ',','))
+            f.flush()
 
-        # Walk devices
-        processed=0
-        for device in devices:
-
-            # Check if we should filter it out
-            last_seen_at = device.get('last_seen_at', '0')
-            if last_seen_at < last_seen_after:
-                continue
-            
-            # Get device ID
-            device_id = device['ids']['device_id']
-            logging.debug(f"Processing device {device_id}")
-            
-            # Get info from devices
+        # Devices to export, a listing error stops the export (the devices
+        # listed so far are still exported and it can be resumed)
+        listing = { "error": None, "listed": 0 }
+        def selected():
             try:
-                (code, output) = shell(f"ttn-lw-cli end-devices get {application_id} {device_id} --name --description --root-keys --session")
-                if 0 == code:
-                    try:
-                        f.write(row_to_csv(json.loads(output.decode('utf-8'))) + "\n")
-                        f.flush()
-                        processed += 1
-                    except Exception as e:
-                        logging.error(f"ERROR: parsing device {device_id}: {str(e)}")    
-                else:
-                    logging.error(f"ERROR: processing device {device_id}")
+                for device in devices:
+
+                    # Check if we should filter it out
+                    listing["listed"] += 1
+                    last_seen_at = device.get('last_seen_at', '0')
+                    if last_seen_at < last_seen_after:
+                        continue
+
+                    # Already exported
+                    if device['ids']['device_id'] in done:
+                        continue
+
+                    yield device
+
             except Exception as e:
-                logging.error(f"ERROR: processing device {device_id}: {str(e)}")    
+                listing["error"] = str(e)
+
+        # Walk devices, `workers` at a time, rows are written in the same
+        # order as the devices list
+        workers = int(config.get('thethingsstack.workers', 8))
+        processed=0
+        for (device, (row, error)) in ordered_map(lambda device: (device, get_device(fetch, device, retries)), selected(), workers):
+            logging.debug(f"Processing device {device['ids']['device_id']}")
+            if row is None:
+                logging.error(error)
+                continue
+            f.write(row + "\n")
+            f.flush()
+            journal.add(device['ids']['device_id'])
+            processed += 1
+
+        journal.close()
+
+    # Listing failed, the export is not complete
+    if listing["error"] is not None:
+        if 0 == listing["listed"]:
+            logging.error(f"ERROR: not enough permissions for application {application_id} ({listing['error']})")
+            if not args.resume:
+                os.remove(filename)
+                os.remove(filename + ".journal")
+        else:
+            logging.error(f"ERROR: getting the devices of application {application_id} after {listing['listed']} devices ({listing['error']})")
+            logging.error(f"Export incomplete, {processed} devices saved into {filename}, run again with --resume {filename} to continue")
+        sys.exit(2)
 
     logging.info(f"{processed} devices processed and saved into {filename}")
 
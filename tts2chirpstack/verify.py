@@ -0,0 +1,257 @@
+import os
+import sys
+import time
+
+import grpc
+import csv
+import logging
+import argparse
+
+from chirpstack_api import api
+from datetime import datetime
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from common.config import Config
+from common.utils import get_pass, get_input
+from common.pool import ordered_map
+from common.paginate import paginate
+
+# -----------------------------------------------------------------------------
+# Globals
+# -----------------------------------------------------------------------------
+
+APP_NAME = "Chirpstack Device Import Verification"
+APP_VERSION = "v1.0.0"
+
+# Fields compared for each device, the frame counters in ChirpStack can only
+# be the same or higher than the exported ones (the devices keep sending)
+FIELDS = [ 'device_id', 'app_key', 'dev_addr', 'app_s_key', 'nwk_s_enc_key', 's_nwk_s_int_key', 'f_nwk_s_int_key', 'f_cnt_up', 'n_f_cnt_down', 'a_f_cnt_down' ]
+SESSION = [ 'dev_addr', 'app_s_key', 'nwk_s_enc_key', 's_nwk_s_int_key', 'f_nwk_s_int_key', 'f_cnt_up', 'n_f_cnt_down', 'a_f_cnt_down' ]
+COUNTERS = [ 'f_cnt_up', 'n_f_cnt_down', 'a_f_cnt_down' ]
+
+# -----------------------------------------------------------------------------
+# Methods
+# -----------------------------------------------------------------------------
+
+def get_total(client, auth_token, application_id):
+
+  # Number of devices in the application, from a single item page
+  req = api.ListDevicesRequest()
+  req.application_id = application_id
+  req.limit = 1
+  return client.List(req, metadata=auth_token).total_count
+
+def get_devices(client, auth_token, application_id, page_size=1000, prefetch=False):
+
+  req = api.ListDevicesRequest()
+  req.application_id = application_id
+  yield from paginate(client.List, req, auth_token, page_size, prefetch)
+
+def get_device_state(client, auth_token, device):
+
+  # Keys and activation of a device at the same time, returns the values in
+  # FIELDS order and the error, if any (not found counts as empty)
+  dev_eui = device.dev_eui
+  req = api.GetDeviceKeysRequest()
+  req.dev_eui = dev_eui
+  keys = client.GetKeys.future(req, metadata=auth_token)
+  req = api.GetDeviceActivationRequest()
+  req.dev_eui = dev_eui
+  activation = client.GetActivation.future(req, metadata=auth_token)
+
+  values = { 'device_id': device.name }
+  try:
+    values['app_key'] = keys.result().device_keys.nwk_key
+  except grpc.RpcError as err:
+    if grpc.StatusCode.NOT_FOUND != err.code():
+      return (None, f"error getting the keys ({err.details()})")
+  try:
+    current = activation.result().device_activation
+    for field in SESSION:
+      values[field] = str(getattr(current, field))
+  except grpc.RpcError as err:
+    if grpc.StatusCode.NOT_FOUND != err.code():
+      return (None, f"error getting the activation ({err.details()})")
+
+  return (tuple([ values.get(field, '') for field in FIELDS ]), None)
+
+def get_rows(filename):
+
+  # Rows in the exported CSV, one at a time, as (dev_eui, values in FIELDS order)
+  with open(filename, 'r') as file:
+    for row in csv.DictReader(file):
+      yield (str(row.get('dev_eui', '')).lower(), tuple([ row.get(field) or '' for field in FIELDS ]))
+
+def count_rows(filename):
+  with open(filename, 'r') as file:
+    return max(0, sum(1 for line in file) - 1)
+
+def compare(expected, current):
+
+  # Names of the fields that do not match, the session is only checked if
+  # there was one in the export
+  has_session = '' != expected[FIELDS.index('dev_addr')]
+  fields = []
+  for (field, want, have) in zip(FIELDS, expected, current):
+    if '' == want or (field in SESSION and not has_session):
+      continue
+    if field in COUNTERS:
+      if int('0'+have) < int('0'+want):
+        fields.append(field)
+    elif want.lower() != have.lower():
+      fields.append(field)
+  return fields
+
+# -----------------------------------------------------------------------------
+# Entrypoint
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+
+    # Start time
+    start = time.time()
+    now = datetime.utcnow()
+
+    # CLI arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", "-c", default="config.yml", help = "Configuration file")
+    parser.add_argument("--server", dest="CHIRPSTACK_SERVER", help = "Chirpstack server (ip/domain and port)")
+    parser.add_argument("--api-token", dest="CHIRPSTACK_API_TOKEN", help = "API token with permissions on the application")
+    parser.add_argument("--application-id", dest="CHIRPSTACK_APPLICATION_ID", help = "Application EUI the devices were imported to")
+    parser.add_argument("--filename", dest="FILENAME", help = "File with the exported devices")
+    parser.add_argument("--report", dest="REPORT", help = "File to save the devices that do not match to")
+    parser.add_argument("-y", action='store_true', help = "Skip interactive promt")
+    args = parser.parse_args()
+
+    # Load configuration file
+    config = Config(file=args.config, args=vars(args))
+
+    # Set logging level based on settings (10=DEBUG, 20=INFO, ...)
+    level=config.get("logging.level", logging.DEBUG)
+    logging.basicConfig(format='[%(asctime)s] %(message)s', level=level)
+    logging.info(f"{APP_NAME} {APP_VERSION}")
+    logging.debug(f"Setting logging level to {level}")
+
+    # Interactive prompt
+    if not args.y:
+      logging.debug("Interactive prompt")
+      print()
+      config.set('chirpstack.server', get_input("Chirpstack server (ip/domain and port)", config.get('chirpstack.server')))
+      config.set('chirpstack.api_token', get_pass("API token with permissions on the application", config.get('chirpstack.api_token')))
+      config.set('chirpstack.application_id', get_input("Application EUI the devices were imported to", config.get('chirpstack.application_id')))
+      config.set('filename', get_input("File with the exported devices", config.get('filename')))
+      print()
+
+    # Some variables and checks
+    filename = config.get('filename')
+    if not filename:
+        logging.error("ERROR: Missing file to verify")
+        sys.exit()
+    application_id = config.get('chirpstack.application_id')
+    if not application_id:
+        logging.error("ERROR: Missing application_id to verify")
+        sys.exit()
+    server = config.get('chirpstack.server', 'localhost:8080')
+    report_filename = config.get('report', os.path.splitext(filename)[0] + "_verify.csv")
+
+    # Hello
+    logging.info(f"Verifying devices from {filename} against {server} on app ID {application_id}")
+
+    # Define the API key meta-data.
+    auth_token = [("authorization", "Bearer %s" % config.get('chirpstack.api_token'))]
+
+    # Connect without using TLS.
+    channel = grpc.insecure_channel(server)
+
+    # Device API client, shared by all the calls
+    client = api.DeviceServiceStub(channel)
+
+    # Options
+    page_size = int(config.get('chirpstack.page_size', 1000))
+    prefetch = bool(config.get('chirpstack.prefetch', False))
+    workers = int(config.get('chirpstack.workers', 8))
+
+    # Size of both sides
+    try:
+      total = get_total(client, auth_token, application_id)
+    except Exception as e:
+      logging.error(f"ERROR: getting the list of devices in the application ({str(e)})")
+      sys.exit(2)
+    rows = count_rows(filename)
+    logging.info(f"{rows} devices in the file, {total} devices in the application")
+
+    # Devices that do not match go to the report, the rest are only counted
+    counters = { "ok": 0, "mismatched": 0, "missing": 0, "extra": 0, "failed": 0 }
+    mismatches = {}
+    with open(report_filename, "w", newline='') as report:
+      writer = csv.writer(report)
+      writer.writerow([ "dev_eui", "device_id", "status", "fields" ])
+
+      def check(dev_eui, device_id, expected, current, error):
+        if expected is None:
+          status = "extra"
+        elif current is None and error is None:
+          status = "missing"
+        elif error:
+          status = "failed"
+        else:
+          fields = compare(expected, current)
+          status = "mismatched" if fields else "ok"
+          error = ' '.join(fields)
+          for field in fields:
+            mismatches[field] = mismatches.get(field, 0) + 1
+        counters[status] += 1
+        if "ok" != status:
+          logging.debug(f"{dev_eui}: {status} {error or ''}")
+          writer.writerow([ dev_eui, device_id, status, error or '' ])
+
+      # The smaller side is kept in a hash index by dev_eui and the other one
+      # is streamed against it, devices in ChirpStack are fetched `workers` at a time
+      devices = get_devices(client, auth_token, application_id, page_size, prefetch)
+      try:
+        if rows <= total:
+
+          index = dict(get_rows(filename))
+          def fetch(device):
+            if device.dev_eui not in index:
+              return (device, None, None)
+            return (device, ) + get_device_state(client, auth_token, device)
+          for (device, current, error) in ordered_map(fetch, devices, workers):
+            expected = index.pop(device.dev_eui, None)
+            check(device.dev_eui, device.name, expected, current, error)
+          for (dev_eui, expected) in index.items():
+            check(dev_eui, expected[0], expected, None, None)
+
+        else:
+
+          fetch = lambda device: (device, ) + get_device_state(client, auth_token, device)
+          index = { device.dev_eui: (device.name, current, error) for (device, current, error) in ordered_map(fetch, devices, workers) }
+          for (dev_eui, expected) in get_rows(filename):
+            (device_id, current, error) = index.pop(dev_eui, (expected[0], None, None))
+            check(dev_eui, device_id, expected, current, error)
+          for (dev_eui, (device_id, current, error)) in index.items():
+            check(dev_eui, device_id, None, current, error)
+
+      except Exception as e:
+        logging.error(f"ERROR: verifying the devices in the application ({str(e)})")
+        sys.exit(2)
+
+    # Summary
+    logging.info(f"{counters['ok']} devices match")
+    logging.info(f"{counters['mismatched']} devices with different values")
+    for field in FIELDS:
+      if field in mismatches:
+        logging.info(f" * {field}: {mismatches[field]} devices")
+    logging.info(f"{counters['missing']} devices missing in ChirpStack")
+    logging.info(f"{counters['extra']} devices in ChirpStack not in the file")
+    if counters['failed']:
+      logging.info(f"{counters['failed']} devices could not be checked")
+    if counters['ok'] < sum(counters.values()):
+      logging.info(f"Devices that do not match saved to {report_filename}")
+
+    total_time=round(time.time() - start, 2)
+    logging.info(f"Total time {total_time}s")
+
+    # Non zero exit code if something does not match, for scripting
+    if counters['ok'] < sum(counters.values()):
+      sys.exit(1)